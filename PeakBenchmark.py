@@ -0,0 +1,433 @@
+from bisect import bisect_left, bisect_right
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+import PeakConverter
+
+"""
+This program benchmarks PeakConverter on synthetic, genome-scale inputs.
+It generates a UCSC-format annotation table, a matching cufflinks
+isoforms.fpkm_tracking file and narrowPeak files of several sizes, times and
+memory-profiles every stage of the conversion, checks that the array-based
+engines give the same results as the original per-transcript implementation
+and writes the results to a JSON file for comparison across commits.
+"""
+
+TRACE_MEMORY = True   # Measure the peak traced memory of every stage (see measure)
+CHROMOSOMES = ['chr'+str(n) for n in range(1, 23)] + ['chrX', 'chrY', 'chrUn_gl000220']
+
+
+def generate_table(table_file, genes, max_isoforms=4, mean_exons=8, minus_fraction=0.5,
+                   noncoding_fraction=0.2, seed=1):
+    """
+    This function writes a synthetic UCSC table file (RefSeq/GENCODE column layout,
+    with a bin header) of the given number of genes. Every gene gets a random strand
+    and 1 to max_isoforms isoforms, each built from a random subset of the gene's
+    exons, with a random CDS or none for non-coding isoforms. A few isoforms are
+    duplicated at a second locus, like PAR genes. It returns the number of
+    transcripts written.
+    """
+    rng = np.random.default_rng(seed)
+    positions = dict.fromkeys(CHROMOSOMES, 10000)
+    transcripts = 0
+    with open(table_file, 'w') as table:
+        print('#bin', 'name', 'chrom', 'strand', 'txStart', 'txEnd', 'cdsStart', 'cdsEnd',
+              'exonCount', 'exonStarts', 'exonEnds', 'score', 'name2', 'cdsStartStat',
+              'cdsEndStat', 'exonFrames', sep='\t', file=table)
+        for gene in range(genes):
+            chrom = CHROMOSOMES[rng.integers(len(CHROMOSOMES))]
+            strand = '-' if rng.random() < minus_fraction else '+'
+            exon_count = 1 + rng.geometric(1 / mean_exons)
+            lengths = np.maximum(rng.lognormal(5, 0.7, exon_count).astype(np.int64), 20)
+            introns = np.maximum(rng.lognormal(7.5, 1.2, exon_count).astype(np.int64), 60)
+            starts = positions[chrom] + np.concatenate(([0], np.cumsum(lengths + introns)[:-1]))
+            ends = starts + lengths
+            positions[chrom] = int(ends[-1] + rng.integers(1000, 50000))
+            for isoform in range(rng.integers(1, max_isoforms + 1)):
+                keep = rng.random(exon_count) < 0.85
+                keep[rng.integers(exon_count)] = True
+                ex_starts, ex_ends = starts[keep], ends[keep]
+                if rng.random() < noncoding_fraction:
+                    cds_start = cds_end = int(ex_ends[-1])
+                else:
+                    first, last = sorted(rng.integers(len(ex_starts), size=2))
+                    cds_start = int(rng.integers(ex_starts[first], ex_ends[first]))
+                    cds_end = int(rng.integers(max(cds_start, ex_starts[last]), ex_ends[last] + 1))
+                loci = [(chrom, 0)]
+                if rng.random() < 0.005:
+                    loci.append(('chrY', int(rng.integers(1, 100)) * 1000000))
+                for locus_chrom, shift in loci:
+                    print(0, 'NM_'+str(gene)+'_'+str(isoform), locus_chrom, strand,
+                          ex_starts[0] + shift, ex_ends[-1] + shift, cds_start + shift,
+                          cds_end + shift, len(ex_starts),
+                          ''.join(str(st + shift)+',' for st in ex_starts),
+                          ''.join(str(end + shift)+',' for end in ex_ends), 0,
+                          'GENE'+str(gene), 'cmpl', 'cmpl', '0,' * len(ex_starts),
+                          sep='\t', file=table)
+                    transcripts += 1
+    return transcripts
+
+
+def generate_expression(expression_file, annotation, seed=1):
+    """
+    This function writes a cufflinks isoforms.fpkm_tracking file matching an annotation
+    Transcriptome, with log-normal FPKMs and a share of unexpressed (tied) isoforms.
+    """
+    rng = np.random.default_rng(seed)
+    tx_ids, first = np.unique(annotation.tx_ids, return_index=True)
+    fpkm = np.round(rng.lognormal(1, 2, len(tx_ids)), 3)
+    fpkm[rng.random(len(tx_ids)) < 0.2] = 0
+    expression = pd.DataFrame({'tracking_id': tx_ids, 'class_code': '-', 'nearest_ref_id': '-',
+                               'gene_id': tx_ids, 'gene_short_name': '-', 'tss_id': '-',
+                               'locus': '-', 'length': annotation.lengths[first], 'coverage': 0,
+                               'FPKM': fpkm, 'FPKM_conf_lo': 0, 'FPKM_conf_hi': 0,
+                               'FPKM_status': 'OK'})
+    expression.to_csv(expression_file, sep='\t', index=False)
+
+
+def generate_peaks(bed_file, annotation, peaks, seed=1):
+    """
+    This function writes a narrowPeak file of the given number of peaks, sorted by
+    chromosome and start. Peaks are centered on random exons of the annotation (so
+    most of them overlap exons, some spanning junctions) with random widths.
+    """
+    rng = np.random.default_rng(seed)
+    exon = rng.integers(len(annotation.exon_starts), size=peaks)
+    centers = rng.integers(annotation.exon_starts[exon] - 100, annotation.exon_ends[exon] + 100)
+    widths = rng.integers(50, 600, size=peaks)
+    starts = np.maximum(centers - widths // 2, 0)
+    chroms = annotation.chroms[annotation.exon_tx[exon]]
+    order = np.lexsort((starts, chroms))
+    bed = pd.DataFrame({'chrom': chroms[order], 'start': starts[order],
+                        'end': starts[order] + widths[order],
+                        'name': ['peak_'+str(i) for i in range(peaks)],
+                        'score': rng.integers(10, 1000, size=peaks), 'strand': '.',
+                        'signal': np.round(rng.random(peaks) * 20, 3), 'p': 5.0, 'q': 3.0,
+                        'summit': widths[order] // 2})
+    bed.to_csv(bed_file, sep='\t', header=False, index=False)
+
+
+def measure(results, stage, function, *arguments, peaks=None, records=None):
+    """
+    This function runs a stage, records its wall time, CPU time, peak traced memory
+    and the process' peak RSS in results and returns the stage's return value.
+    records is a function of the return value giving the number of records produced.
+    Because tracing allocations slows Python code down considerably, the stage is
+    timed untraced and, if TRACE_MEMORY is set, run a second time under tracemalloc.
+    """
+    wall, cpu = time.perf_counter(), time.process_time()
+    value = function(*arguments)
+    wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+    peak_memory = None
+    if TRACE_MEMORY:
+        tracemalloc.start()
+        function(*arguments)
+        peak_memory = round(tracemalloc.get_traced_memory()[1] / 2 ** 20, 2)
+        tracemalloc.stop()
+    entry = {'stage': stage, 'peaks': peaks, 'seconds': round(wall, 4),
+             'cpu_seconds': round(cpu, 4), 'peak_memory_mb': peak_memory,
+             'max_rss_mb': round(PeakConverter.max_rss_mb(), 2),
+             'records': records(value) if records else None}
+    results.append(entry)
+    print("---"+stage+(" ("+str(peaks)+" peaks)" if peaks else "")+": "+"%.3f" % wall+" s" +
+          (", "+"%.1f" % peak_memory+" MB" if peak_memory is not None else ""))
+    return value
+
+
+def reference_choose_isoforms(expression_file, table_file):
+    """
+    This function is a line-by-line reference of the documented isoform selection
+    rule (see PeakConverter.rank_isoforms): it reads a cufflinks isoforms.fpkm_tracking
+    file and keeps, for every gene, the isoform with the highest FPKM, then coding
+    isoforms, then the longest one, the first listed isoform winning remaining ties.
+    (The original elif chain let a longer non-coding isoform replace an equally
+    expressed coding one; the documented rule does not.)
+    It returns a set of the chosen isoforms.
+    """
+    gene_dict = PeakConverter.isoform_gene_dict(table_file)
+    best = {}
+    with open(expression_file, 'r') as input_f:
+        input_f.readline()
+        for line in input_f:
+            fields = line.rstrip('\n').split('\t')
+            isoform = fields[3]
+            if isoform not in gene_dict:
+                continue
+            gene, coding = gene_dict[isoform]
+            key = (float(fields[9]), coding, int(fields[7]))
+            if gene not in best or key > best[gene][0]:
+                best[gene] = (key, isoform)
+    return {isoform for key, isoform in best.values()}
+
+
+def reference_gen2tr(peaks, transcriptome, merge_distance=10):
+    """
+    This function is the reference implementation of the conversion, following the
+    original per-transcript code: every peak is matched with the exons of uniquely
+    mapped isoforms (through Transcript-like objects), converted with the original
+    per-overlap arithmetic, then sorted and merged like bedtools sort | merge -nms.
+    It returns the merged transcriptomic and exon-limited peaks as lists of tuples.
+    """
+    exons = {}
+    for transcripts in transcriptome.to_dict('txid').values():
+        if len(transcripts) == 1:
+            tx = transcripts[0]
+            for order, (exon_st, exon_end, tr_exon_st) in enumerate(
+                    zip(tx.genomic_starts, tx.genomic_ends, tx.trans_starts)):
+                exons.setdefault(tx.chrom, []).append((exon_st, exon_end, tx.strand, tx.uid,
+                                                       tr_exon_st, (tx.uid, order)))
+    longest = {}
+    for chrom in exons:
+        exons[chrom].sort()
+        longest[chrom] = max(exon_end - exon_st for exon_st, exon_end, *_ in exons[chrom])
+    exon_starts = {chrom: [exon[0] for exon in exons[chrom]] for chrom in exons}
+    tr_rows, elp_rows = [], []
+    for chrom, p_start, p_end, peak_id in peaks.itertuples(index=False):
+        if chrom not in exons:
+            continue
+        lo = bisect_right(exon_starts[chrom], p_start - longest[chrom])
+        hi = bisect_left(exon_starts[chrom], p_end)
+        hits = sorted((exon for exon in exons[chrom][lo:hi] if exon[1] > p_start),
+                      key=lambda exon: exon[5])
+        for ex_st, ex_end, strand, uid, tr_exon_start, _ in hits:
+            overlap = min(p_end, ex_end) - max(p_start, ex_st)
+            if strand == "+":
+                gap = p_start - ex_st if p_start > ex_st else 0
+            else:
+                gap = ex_end - p_end if p_end < ex_end else 0
+            tr_rows.append((uid, tr_exon_start+gap, tr_exon_start+gap+overlap, peak_id))
+            if overlap >= 0.5 * (p_end - p_start):
+                elp_rows.append((chrom, max(p_start, ex_st), min(p_end, ex_end), peak_id))
+    return reference_merge(tr_rows, merge_distance), reference_merge(elp_rows, 0)
+
+
+def reference_tx_rows(trdf, transcriptome):
+    """
+    This function is the reference implementation of the tx rows, following the
+    original pipeline: the merged transcriptomic peaks are joined to the parameters of
+    every transcript (see PeakConverter.get_parameters) with pd.merge, deduplicated,
+    filtered to peaks longer than 50 nt and sorted by transcript ID and peak start.
+    It returns a dataframe in the column order of the tx file.
+    """
+    trdf = trdf.copy()
+    trdf['Peak_Middle'] = np.rint((trdf['Peak_Start'].values+trdf['Peak_End'].values)/2).astype(np.int64)
+    merged = pd.merge(trdf, PeakConverter.get_parameters(transcriptome), on='UID')
+    merged.drop_duplicates(inplace=True)
+    merged = merged[['Tx_ID', 'Peak_Start', 'Peak_End', 'Peak_Names', 'Peak_Middle', 'ATG', 'Stop',
+                     'Length', 'FirstSpliceSite', 'LastSpliceSite']]
+    merged = merged[(merged.Peak_End - merged.Peak_Start) > 50]
+    merged.sort_values(['Tx_ID', 'Peak_Start'], inplace=True)
+    return merged
+
+
+def reference_merge(rows, distance):
+    """
+    This function sorts (key, start, end, name) rows by key and start and merges
+    rows at most distance bases apart, collapsing names with ";".
+    """
+    merged = []
+    for key, start, end, name in sorted(rows, key=lambda row: (row[0], row[1])):
+        if merged and merged[-1][0] == key and start - merged[-1][2] <= distance:
+            merged[-1][2] = max(merged[-1][2], end)
+            merged[-1][3].append(str(name))
+        else:
+            merged.append([key, start, end, [str(name)]])
+    return [(key, start, end, ';'.join(names)) for key, start, end, names in merged]
+
+
+def check_bed_header(bed_file, peaks_df):
+    """
+    This function writes a copy of a BED file with track, browser and comment header
+    lines (like older MACS2 _peaks.bed files) and reads it with every BED reader
+    (whole, by chromosome and in chunks). It returns the number of readers whose
+    peaks differ from peaks_df or that fail on the header.
+    """
+    header_file = bed_file+'.track.bed'
+    with open(header_file, 'w') as opened_header_file, open(bed_file) as opened_bed:
+        opened_header_file.write('track name=peaks description="Benchmark peaks"\n'
+                                 'browser position chr1:1-1000\n# Synthetic peaks\n')
+        opened_header_file.write(opened_bed.read())
+    readers = [lambda: PeakConverter.read_bed_into_dataframe(header_file),
+               lambda: pd.concat([chrom_peaks for chrom, chrom_peaks in
+                                  PeakConverter.iter_bed_chromosomes(header_file)], ignore_index=True),
+               lambda: PeakConverter.BedChunkReader(header_file,
+                                                    chunksize=max(len(peaks_df) // 7, 1)).dataframe()]
+    mismatches = 0
+    for reader in readers:
+        try:
+            mismatches += not reader().equals(peaks_df)
+        except (ValueError, PeakConverter.PeakConverterError):
+            mismatches += 1
+    os.remove(header_file)
+    return mismatches
+
+
+def check_transcriptome(legacy_dict, transcriptome):
+    """
+    This function compares the legacy Transcript objects with the columnar
+    Transcriptome, transcript by transcript. It returns the number of mismatches.
+    """
+    mismatches = 0
+    for index in range(len(transcriptome)):
+        view = transcriptome[index]
+        tx = legacy_dict[view.uid][0]
+        if (list(tx.trans_starts) != list(view.trans_starts) or len(tx) != len(view) or
+                (tx.ctis if tx.ctis is not None else -1) != view.ctis or
+                (tx.stop if tx.stop is not None else -1) != view.stop or
+                tx.genomic_starts != view.genomic_starts or tx.id != view.id):
+            mismatches += 1
+    return mismatches
+
+
+def record_check(checks, name, mismatches, peaks=None):
+    """
+    This function records the result of an equivalence check and prints it.
+    """
+    checks.append({'check': name, 'peaks': peaks, 'passed': mismatches == 0,
+                   'mismatches': int(mismatches)})
+    print("---Check "+name+(" ("+str(peaks)+" peaks)" if peaks else "")+": " +
+          ("passed" if mismatches == 0 else "FAILED with "+str(mismatches)+" mismatches"))
+
+
+def run_benchmark(args):
+    """
+    This function generates the synthetic inputs, runs every stage for every peak set
+    size and returns the benchmark report as a dictionary.
+    """
+    os.makedirs(args.workdir, exist_ok=True)
+    table_file = os.path.join(args.workdir, 'synthetic.table')
+    expression_file = os.path.join(args.workdir, 'isoforms.fpkm_tracking')
+    print("Generating annotation table of "+str(args.genes)+" genes...", end=" ")
+    transcripts = generate_table(table_file, args.genes, args.max_isoforms, args.mean_exons,
+                                 args.minus_fraction, args.noncoding_fraction, args.seed)
+    annotation = PeakConverter.read_table_into_transcriptome(table_file)
+    generate_expression(expression_file, annotation, args.seed)
+    print("Done! ("+str(transcripts)+" transcripts, "+str(len(annotation.exon_starts))+" exons)")
+    results, checks = [], []
+    table_array = measure(results, 'read_table_into_array', PeakConverter.read_table_into_array,
+                          table_file, records=len)
+    legacy_dict = measure(results, 'build_transcriptome', PeakConverter.build_transcriptome,
+                          table_array, records=len)
+    annotation = measure(results, 'read_table_into_transcriptome',
+                         PeakConverter.read_table_into_transcriptome, table_file, records=len)
+    record_check(checks, 'transcriptome_vs_transcript_objects',
+                 check_transcriptome(legacy_dict, annotation))
+    del table_array, legacy_dict
+    chosen = measure(results, 'choose_selected_cufflinks', PeakConverter.choose_selected_cufflinks,
+                     expression_file, table_file, records=len)
+    chosen_fast = measure(results, 'choose_selected_isoforms', PeakConverter.choose_selected_isoforms,
+                          expression_file, annotation.gene_table(), records=len)
+    chosen_reference = reference_choose_isoforms(expression_file, table_file)
+    record_check(checks, 'isoform_selection', len(chosen ^ chosen_reference) +
+                 len(chosen_fast ^ chosen_reference))
+    selected = annotation.select(chosen_fast)
+    measure(results, 'get_parameters', PeakConverter.get_parameters, selected, records=len)
+    converter = measure(results, 'build_converter', PeakConverter.Converter, selected)
+    for peaks in args.peaks:
+        bed_file = os.path.join(args.workdir, 'peaks_'+str(peaks)+'.narrowPeak')
+        generate_peaks(bed_file, annotation, peaks, args.seed)
+        peaks_df = measure(results, 'read_bed', PeakConverter.read_bed_into_dataframe, bed_file,
+                           peaks=peaks, records=len)
+        trdf, merged_elp = measure(results, 'gen2tr', converter.intersect, peaks_df, peaks=peaks,
+                                   records=lambda value: len(value[0]))
+        merged = measure(results, 'add_parameters', converter.add_parameters, trdf, peaks=peaks,
+                         records=len)
+        tx_file = os.path.join(args.workdir, 'peaks_'+str(peaks)+'_tx.bed')
+        measure(results, 'write', PeakConverter.write_tx_rows, merged, tx_file, peaks=peaks)
+        if peaks <= args.check_limit:
+            ref_tr, ref_elp = reference_gen2tr(peaks_df, selected)
+            fast_tr = sorted(zip(trdf.UID.tolist(), trdf.Peak_Start.tolist(),   # In UID order
+                                 trdf.Peak_End.tolist(), trdf.Peak_Names.tolist()),
+                             key=lambda row: (row[0], row[1]))
+            fast_elp = list(zip(merged_elp.Chrom.tolist(), merged_elp.Start.tolist(),
+                                merged_elp.End.tolist(), merged_elp.Name.tolist()))
+            record_check(checks, 'gen2tr_vs_reference',
+                         sum(a != b for a, b in zip(ref_tr, fast_tr)) + abs(len(ref_tr) - len(fast_tr)),
+                         peaks)
+            record_check(checks, 'exon_limited_peaks_vs_reference',
+                         sum(a != b for a, b in zip(ref_elp, fast_elp)) + abs(len(ref_elp) - len(fast_elp)),
+                         peaks)
+            ref_rows = reference_tx_rows(trdf, selected).to_csv(sep='\t', header=False, index=False)
+            fast_rows = merged.to_csv(sep='\t', header=False, index=False)
+            ref_lines, fast_lines = ref_rows.splitlines(), fast_rows.splitlines()
+            record_check(checks, 'tx_rows_vs_reference',
+                         sum(a != b for a, b in zip(ref_lines, fast_lines)) +
+                         abs(len(ref_lines) - len(fast_lines)), peaks)
+            record_check(checks, 'bed_track_header', check_bed_header(bed_file, peaks_df), peaks)
+        if not args.keep_files:
+            os.remove(bed_file)
+            os.remove(tx_file)
+    return {'commit': git_commit(), 'python': platform.python_version(),
+            'numpy': np.__version__, 'pandas': pd.__version__, 'platform': platform.platform(),
+            'config': {'genes': args.genes, 'transcripts': transcripts,
+                       'exons': int(len(annotation.exon_starts)), 'peaks': args.peaks,
+                       'max_isoforms': args.max_isoforms, 'mean_exons': args.mean_exons,
+                       'minus_fraction': args.minus_fraction,
+                       'noncoding_fraction': args.noncoding_fraction, 'seed': args.seed},
+            'results': results, 'checks': checks}
+
+
+def git_commit():
+    """
+    This function returns the git commit of the PeakConverter checkout, if any.
+    """
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def get_user_arguments():
+    """
+    This function parses the user supplied arguments using argparse.
+    It returns a parser.parse_args object.
+    """
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--genes', action='store', dest='genes', type=int, default=20000,
+                        help='Number of genes in the synthetic annotation')
+    parser.add_argument('--max-isoforms', action='store', dest='max_isoforms', type=int, default=4,
+                        help='Maximum number of isoforms per gene')
+    parser.add_argument('--mean-exons', action='store', dest='mean_exons', type=float, default=8,
+                        help='Mean number of exons per gene')
+    parser.add_argument('--minus-fraction', action='store', dest='minus_fraction', type=float,
+                        default=0.5, help='Fraction of genes on the minus strand')
+    parser.add_argument('--noncoding-fraction', action='store', dest='noncoding_fraction',
+                        type=float, default=0.2, help='Fraction of non-coding isoforms')
+    parser.add_argument('--peaks', action='store', dest='peaks', type=int, nargs='+',
+                        default=[10000, 100000, 1000000, 5000000],
+                        help='Sizes of the synthetic narrowPeak files')
+    parser.add_argument('--check-limit', action='store', dest='check_limit', type=int,
+                        default=100000,
+                        help='Check conversion results against the reference implementation '
+                             'for peak sets up to this size')
+    parser.add_argument('--seed', action='store', dest='seed', type=int, default=1,
+                        help='Random seed of the synthetic inputs')
+    parser.add_argument('--workdir', action='store', dest='workdir', default='benchmark_data',
+                        help='Directory for the synthetic input files')
+    parser.add_argument('--keep-files', action='store_true', dest='keep_files',
+                        help='Keep the generated peak and output files')
+    parser.add_argument('--no-memory', action='store_false', dest='memory',
+                        help='Only time the stages, without the second, memory-traced run')
+    parser.add_argument('--output', action='store', dest='output', default='benchmark.json',
+                        help='Path of the JSON results file')
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = get_user_arguments()
+    TRACE_MEMORY = args.memory
+    report = run_benchmark(args)
+    with open(args.output, 'w') as output:
+        json.dump(report, output, indent=2)
+    print("Results written to "+args.output)
+    if not all(check['passed'] for check in report['checks']):
+        print("Some implementations disagree!")
+        sys.exit(1)
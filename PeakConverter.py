@@ -1,9 +1,32 @@
 from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from signal import signal, SIGPIPE, SIG_DFL
-import subprocess
-import tempfile
+import contextlib
+import cProfile
+import gzip
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import pstats
+import queue
+import shutil
 import sys
+import tempfile
+import threading
+import time
+import warnings
+import numpy as np
 import pandas as pd
+try:
+    import resource
+except ImportError:   # Not available on Windows; peak RSS is then not reported
+    resource = None
+try:
+    from isal import igzip_threaded
+except ImportError:   # python-isal is optional; gzip input is then decompressed with the gzip module
+    igzip_threaded = None
 
 """
 This program receives the RefSeq UCSC table file and a cufflinks isoform FPKM
@@ -14,6 +37,159 @@ RefSeq, Ensemble and GENCODE.
 DOES NOT WORK WITH UCSC ANNOTATION.
 """
 
+ANNOTATION_CACHE_VERSION = 1   # Bump whenever the Transcriptome columns change
+RESULT_CACHE_VERSION = 1   # Bump whenever the cached overlaps (see ResultCache) change
+BED_FORMAT_ERROR = ("The BED file is not at the right format.\n"
+                    "Please supply a tab-separated file with chromosome, start, end and name columns "
+                    "and integer coordinates.")
+TABLE_FORMAT_ERROR = ("The table file is not at the right format.\n"
+                      "Please remember only RefSeq/GENCODE/Ensemble annotations are supported.")
+
+
+class PeakConverterError(Exception):
+    """
+    Raised on invalid input (table, expression, BED or manifest files). The message
+    is the one printed by the command line before it aborts.
+    """
+
+
+class PeakConverterWarning(UserWarning):
+    """
+    Issued for recoverable input problems, such as a few expression file isoforms
+    missing from the table file. The command line reports the message and goes on.
+    """
+
+
+STAGES = ['load_annotation', 'read_expression', 'choose_isoforms', 'build_converter', 'read_bed', 'intersect',
+          'merge', 'parameters', 'write', 'stream', 'metagene', 'tr2gen', 'batch']
+
+
+def max_rss_mb(children=False):
+    """
+    This function returns the peak resident set size in MB of the process, or of its
+    largest finished child process if children is True (None where unsupported).
+    """
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF).ru_maxrss
+    return rss / 2 ** 20 if sys.platform == 'darwin' else rss / 2 ** 10
+
+
+class Metrics:
+    """
+    Records the wall time, CPU time (including finished child processes), peak RSS
+    and input/output record counts of every pipeline stage (see STAGES), and prints
+    the progress messages of the command line. verbosity 0 prints nothing, 1 prints
+    the progress messages and 2 adds the measurements of every stage. The stage
+    named profile_stage is run under cProfile and its statistics are written to
+    profile_file. Background stages run on threads of their own while the main
+    thread goes on (see stage).
+    """
+    def __init__(self, verbosity=1, profile_stage=None, profile_file=None):
+        self.verbosity = verbosity
+        self.profile_stage = profile_stage
+        self.profile_file = profile_file
+        self.stages = []
+        self.samples = []   # Stages of every batch sample (see run_batch)
+        self.background = {}   # Finished background stage name -> (record, message, profiler)
+        self.start = time.perf_counter()
+
+    def log(self, message):
+        """
+        This class function prints a progress message unless verbosity is 0.
+        """
+        if self.verbosity:
+            print(message)
+
+    @contextlib.contextmanager
+    def stage(self, name, message=None, background=False):
+        """
+        This class function measures the stage run in its with block. It yields a
+        dictionary in which the block stores its record counts (such as peaks or
+        tx_rows). A background stage runs on a thread other than the main one: its
+        CPU time is that of its own thread, and its message and measurements are
+        printed only once the main thread calls show.
+        """
+        counts = {}
+        if message and self.verbosity and not background:
+            print(message+"...", end=" ", flush=True)
+        profiler = cProfile.Profile() if name == self.profile_stage else None
+        cpu_time = time.thread_time if background else lambda: sum(os.times()[:4])
+        cpu = cpu_time()
+        wall = time.perf_counter()
+        if profiler:
+            profiler.enable()
+        try:
+            yield counts
+        finally:
+            if profiler:
+                profiler.disable()
+        wall = time.perf_counter() - wall
+        cpu = cpu_time() - cpu
+        record = {'stage': name, 'wall_seconds': round(wall, 4), 'cpu_seconds': round(cpu, 4),
+                  'max_rss_mb': max_rss_mb(), 'max_child_rss_mb': max_rss_mb(children=True),
+                  'counts': counts}
+        if background:
+            record['background'] = True
+        self.stages.append(record)
+        if profiler:
+            profiler.dump_stats(self.profile_file)
+        if background:
+            self.background[name] = (record, message, profiler)
+        else:
+            if message and self.verbosity:
+                print("Done!")
+            self.print_stage(record, profiler)
+
+    def show(self, name):
+        """
+        This class function prints the message and measurements of the finished
+        background stage name (see stage).
+        """
+        if name not in self.background:
+            return
+        record, message, profiler = self.background.pop(name)
+        if message and self.verbosity:
+            print(message+"... Done!")
+        self.print_stage(record, profiler)
+
+    def print_stage(self, record, profiler=None):
+        """
+        This class function prints the measurements of a stage (and the statistics
+        of its profiler) if verbosity is 2.
+        """
+        if self.verbosity > 1:
+            print("---"+record['stage']+": %.3f s wall, %.3f s CPU" % (record['wall_seconds'],
+                                                                     record['cpu_seconds']) +
+                  (", %.0f MB peak RSS" % record['max_rss_mb'] if resource else "") +
+                  "".join(", "+str(value)+" "+key for key, value in record['counts'].items()))
+            if profiler:
+                pstats.Stats(profiler).sort_stats('cumulative').print_stats(15)
+
+    def report(self):
+        """
+        This class function returns the recorded stages (and batch samples) and the
+        totals of the run as a dictionary.
+        """
+        report = {'stages': self.stages,
+                  'total': {'wall_seconds': round(time.perf_counter() - self.start, 4),
+                            'cpu_seconds': round(sum(os.times()[:4]), 4),
+                            'max_rss_mb': max_rss_mb(),
+                            'max_child_rss_mb': max_rss_mb(children=True)}}
+        if self.samples:
+            report['samples'] = self.samples
+        return report
+
+    def write(self, metrics_file, **extra):
+        """
+        This class function writes the report (see report), updated with any extra
+        entries, to a JSON file.
+        """
+        report = self.report()
+        report.update(extra)
+        with open(metrics_file, 'w') as opened_metrics_file:
+            json.dump(report, opened_metrics_file, indent=1)
+
 
 class Transcript:
     def __init__(self, tx_id, chrom, strand, tx_start, tx_end, cds_start,
@@ -120,8 +296,7 @@ def build_transcriptome(table_array, key='uid'):
     transcripts = {}
     keydict = {'uid': 0, 'gid': 10, 'txid': 1}
     if key not in ['gid', 'txid', 'uid']:
-        print('Invalid key type for transcripts dictionary! Aborting.')
-        sys.exit(0)
+        raise PeakConverterError('Invalid key type for transcripts dictionary! Aborting.')
     else:
         for line in table_array:
             if line[keydict[key]] not in transcripts:   # Check if key already exists in dictionary
@@ -131,138 +306,1083 @@ def build_transcriptome(table_array, key='uid'):
     return transcripts
 
 
-def get_parameters(tx_dict):
+class TranscriptView:
+    """
+    A thin, read-only view of one transcript in a Transcriptome, exposing the same
+    attributes as the class Transcript for code that expects Transcript objects.
+    """
+    def __init__(self, transcriptome, index):
+        self._tm = transcriptome
+        self._i = index
+        self._exons = slice(transcriptome.exon_offsets[index], transcriptome.exon_offsets[index + 1])
+
+    id = property(lambda self: str(self._tm.tx_ids[self._i]))
+    uid = property(lambda self: int(self._tm.uids[self._i]))
+    chrom = property(lambda self: str(self._tm.chroms[self._i]))
+    strand = property(lambda self: str(self._tm.strands[self._i]))
+    txs = property(lambda self: int(self._tm.tx_starts[self._i]))
+    txe = property(lambda self: int(self._tm.tx_ends[self._i]))
+    cdss = property(lambda self: int(self._tm.cds_starts[self._i]))
+    cdse = property(lambda self: int(self._tm.cds_ends[self._i]))
+    gid = property(lambda self: str(self._tm.gene_ids[self._i]))
+    genomic_starts = property(lambda self: self._tm.exon_starts[self._exons].tolist())
+    genomic_ends = property(lambda self: self._tm.exon_ends[self._exons].tolist())
+    trans_starts = property(lambda self: deque(self._tm.tr_exon_starts[self._exons].tolist()))
+    trans_ends = property(lambda self: deque(self._tm.tr_exon_ends[self._exons].tolist()))
+    type = property(lambda self: "coding" if self._tm.coding[self._i] else "non-coding")
+    ctis = property(lambda self: int(self._tm.atg[self._i]))
+    stop = property(lambda self: int(self._tm.stop[self._i]))
+
+    def __len__(self):
+        return int(self._tm.lengths[self._i])
+
+
+class Transcriptome:
+    """
+    A columnar (struct-of-arrays) transcriptome. Per-transcript columns are NumPy
+    arrays indexed by transcript position, and exons of all transcripts are stored
+    in flat arrays (in genomic order within each transcript) delimited by
+    exon_offsets, so transcript i owns exons exon_offsets[i]:exon_offsets[i+1].
+    Transcriptomic exon coordinates, canonical ATG and stop positions and lengths
+    are computed for all transcripts at once. ATG and stop are -1 for non-coding
+    transcripts.
+    """
+    TX_COLUMNS = ['uids', 'tx_ids', 'chroms', 'strands', 'tx_starts', 'tx_ends', 'cds_starts',
+                  'cds_ends', 'gene_ids', 'exon_counts', 'minus', 'lengths', 'coding', 'atg', 'stop']
+    EXON_COLUMNS = ['exon_starts', 'exon_ends', 'exon_tx', 'tr_exon_starts', 'tr_exon_ends']
+
+    def __init__(self, uids, tx_ids, chroms, strands, tx_starts, tx_ends, cds_starts,
+                 cds_ends, gene_ids, exon_offsets, exon_starts, exon_ends):
+        self.uids = np.asarray(uids, dtype=np.int64)
+        self.tx_ids = np.asarray(tx_ids, dtype=str)
+        self.chroms = np.asarray(chroms, dtype=str)
+        self.strands = np.asarray(strands, dtype=str)
+        self.tx_starts = np.asarray(tx_starts, dtype=np.int64)
+        self.tx_ends = np.asarray(tx_ends, dtype=np.int64)
+        self.cds_starts = np.asarray(cds_starts, dtype=np.int64)
+        self.cds_ends = np.asarray(cds_ends, dtype=np.int64)
+        self.gene_ids = np.asarray(gene_ids, dtype=str)
+        self.exon_offsets = np.asarray(exon_offsets, dtype=np.int64)
+        self.exon_starts = np.asarray(exon_starts, dtype=np.int64)
+        self.exon_ends = np.asarray(exon_ends, dtype=np.int64)
+        self.get_transcriptomic_coordinates()
+        self.get_start_stop()
+
+    def __len__(self):
+        return len(self.uids)
+
+    def __getitem__(self, index):
+        return TranscriptView(self, index)
+
+    def get_transcriptomic_coordinates(self):
+        """
+        This class function calculates the transcriptomic coordinates of every exon
+        and the length of every transcript with cumulative sums over the flat exon arrays.
+        """
+        self.exon_counts = np.diff(self.exon_offsets)
+        self.exon_tx = np.repeat(np.arange(len(self.uids)), self.exon_counts)   # Owning transcript of each exon
+        self.minus = self.strands == "-"
+        exon_lengths = self.exon_ends - self.exon_starts
+        cumulative = np.concatenate(([0], np.cumsum(exon_lengths)))
+        self.lengths = cumulative[self.exon_offsets[1:]] - cumulative[self.exon_offsets[:-1]]
+        before = cumulative[:-1] - cumulative[self.exon_offsets[:-1]][self.exon_tx]   # Exon length upstream in genomic order
+        after = self.lengths[self.exon_tx] - before - exon_lengths
+        self.tr_exon_starts = np.where(self.minus[self.exon_tx], after, before)
+        self.tr_exon_ends = self.tr_exon_starts + exon_lengths
+
+    def find_exons(self, positions):
+        """
+        This class function takes one genomic position per transcript and returns, for
+        each transcript, the index of the last exon (in genomic order) containing the
+        position (both exon ends inclusive), or -1 if it falls outside all exons.
+        """
+        key_shift = np.int64(1 << 32)
+        exon_keys = self.exon_tx * key_shift + self.exon_starts
+        tx_index = np.arange(len(self.uids))
+        exon = np.searchsorted(exon_keys, tx_index * key_shift + positions, side='right') - 1
+        found = exon >= self.exon_offsets[:-1]
+        found[found] = positions[found] <= self.exon_ends[exon[found]]
+        return np.where(found, exon, -1)
+
+    def get_start_stop(self):
+        """
+        This class function calculates the transcriptomic coordinates of the canonical
+        start codon and the stop codon for all transcripts. It returns -1 for both if it
+        is a non-coding transcript.
+        """
+        self.coding = self.cds_starts != self.cds_ends
+        exon_s = self.find_exons(self.cds_starts)   # Exon containing the CDS start
+        exon_e = self.find_exons(self.cds_ends)   # Exon containing the CDS end
+        cds_start_tr = np.where(self.minus,
+                                self.tr_exon_starts[exon_s] + self.exon_ends[exon_s] - self.cds_starts,
+                                self.tr_exon_starts[exon_s] + self.cds_starts - self.exon_starts[exon_s])
+        cds_end_tr = np.where(self.minus,
+                              self.tr_exon_starts[exon_e] + self.exon_ends[exon_e] - self.cds_ends,
+                              self.tr_exon_starts[exon_e] + self.cds_ends - self.exon_starts[exon_e])
+        cds_start_tr[~self.coding | (exon_s < 0)] = -1
+        cds_end_tr[~self.coding | (exon_e < 0)] = -1
+        self.atg = np.where(self.minus, cds_end_tr, cds_start_tr)
+        self.stop = np.where(self.minus, cds_start_tr, cds_end_tr)
+
+    @classmethod
+    def from_columns(cls, columns):
+        """
+        This class function builds a Transcriptome from a dictionary holding every
+        column in TX_COLUMNS, EXON_COLUMNS and exon_offsets (for instance a loaded
+        annotation cache) without recomputing anything.
+        """
+        transcriptome = cls.__new__(cls)
+        for column in cls.TX_COLUMNS + cls.EXON_COLUMNS + ['exon_offsets']:
+            setattr(transcriptome, column, columns[column])
+        return transcriptome
+
+    def columns(self):
+        """
+        This class function returns a dictionary of all stored columns, the inverse
+        of from_columns.
+        """
+        return {column: getattr(self, column)
+                for column in self.TX_COLUMNS + self.EXON_COLUMNS + ['exon_offsets']}
+
+    def subset(self, selected):
+        """
+        This class function takes a boolean array over transcripts and returns a new
+        Transcriptome with only the selected transcripts, keeping their UIDs.
+        """
+        columns = {column: getattr(self, column)[selected] for column in self.TX_COLUMNS}
+        exons = selected[self.exon_tx]
+        for column in self.EXON_COLUMNS:
+            columns[column] = getattr(self, column)[exons]
+        columns['exon_offsets'] = np.concatenate(([0], np.cumsum(columns['exon_counts'])))
+        columns['exon_tx'] = np.repeat(np.arange(len(columns['uids'])), columns['exon_counts'])
+        return self.from_columns(columns)
+
+    def select(self, tx_ids):
+        """
+        This class function takes a set of transcript IDs and returns the subset of
+        the transcriptome with these transcripts.
+        """
+        return self.subset(np.isin(self.tx_ids, list(tx_ids)))
+
+    def gene_table(self):
+        """
+        This class function returns a dataframe with the columns Isoform, Gene and
+        Coding (1 or 0), one row per transcript ID, for use in choose_selected_isoforms.
+        Like isoform_gene_dict, the last row wins for duplicated transcript IDs.
+        """
+        genes = pd.DataFrame({'Isoform': self.tx_ids, 'Gene': self.gene_ids,
+                              'Coding': self.coding.astype(np.int8)})
+        return genes.drop_duplicates('Isoform', keep='last')
+
+    def transcript_order(self):
+        """
+        This class function returns a permutation of the flat exon arrays that lists
+        the exons of every transcript in transcript (5' to 3') order, i.e. reversed
+        for minus-strand transcripts.
+        """
+        exon_index = np.arange(len(self.exon_starts))
+        reversed_index = (self.exon_offsets[1:][self.exon_tx] - 1 +
+                          self.exon_offsets[:-1][self.exon_tx] - exon_index)
+        return np.where(self.minus[self.exon_tx], reversed_index, exon_index)
+
+    def unique_mask(self):
+        """
+        This class function returns a boolean array marking transcripts whose
+        transcript ID appears only once in the transcriptome (isoforms without duplicates).
+        """
+        _, inverse, counts = np.unique(self.tx_ids, return_inverse=True, return_counts=True)
+        return counts[inverse] == 1
+
+    def to_dict(self, key='uid'):
+        """
+        This class function returns a dictionary in the format of build_transcriptome,
+        in which the values are lists of TranscriptView objects.
+        """
+        keycols = {'uid': self.uids, 'gid': self.gene_ids, 'txid': self.tx_ids}
+        if key not in keycols:
+            raise PeakConverterError('Invalid key type for transcripts dictionary! Aborting.')
+        transcripts = {}
+        for index, value in enumerate(keycols[key].tolist()):
+            transcripts.setdefault(value, []).append(self[index])
+        return transcripts
+
+    @classmethod
+    def from_table_array(cls, table_array):
+        """
+        This class function builds a Transcriptome from a table array generated by
+        read_table_into_array.
+        """
+        exon_counts = [len(line[8]) for line in table_array]
+        columns = list(zip(*table_array)) if table_array else [[]] * 11
+        return cls(columns[0], columns[1], columns[2], columns[3], columns[4], columns[5],
+                   columns[6], columns[7], columns[10], np.concatenate(([0], np.cumsum(exon_counts))),
+                   [st for line in table_array for st in line[8]],
+                   [end for line in table_array for end in line[9]])
+
+
+def transcript_parameters(transcriptome, tx):
+    """
+    This function takes a Transcriptome and an array of transcript positions and
+    returns a dictionary of int64 arrays with the parameters ATG, Stop, Length,
+    FirstSpliceSite and LastSpliceSite of these transcripts, in the column order
+    of the tx file. ATG and Stop are -1 for non-coding transcripts and splice
+    sites are -1 for unspliced ones.
+    """
+    tm = transcriptome
+    first = tm.exon_offsets[tx]
+    last = tm.exon_offsets[tx + 1] - 1
+    first_len = tm.exon_ends[first] - tm.exon_starts[first]
+    last_len = tm.exon_ends[last] - tm.exon_starts[last]
+    spliced = tm.exon_counts[tx] > 1
+    coding = tm.atg[tx] > 0
+    minus = tm.minus[tx]
+    lengths = tm.lengths[tx]
+    return {'ATG': np.where(coding, tm.atg[tx], -1),
+            'Stop': np.where(coding, tm.stop[tx], -1),
+            'Length': lengths,
+            'FirstSpliceSite': np.where(spliced, np.where(minus, last_len, first_len), -1),
+            'LastSpliceSite': np.where(spliced, lengths - np.where(minus, first_len, last_len), -1)}
+
+
+def get_parameters(transcriptome):
     """
-    This function takes a transcript dictionary and returns a pandas
-    dataframe of the parameters Tx_ID, ATG, Stop, Length, First Splice Site, Last Splice Site and UID.
-    This dataframe will later be used to add these paramters to transcripts for which peaks were
-    mapped to.
+    This function takes a Transcriptome and returns a pandas
+    dataframe of the parameters Tx_ID, ATG, Stop, Length, First Splice Site, Last Splice Site and UID
+    (see transcript_parameters) of every transcript on a chromosome with a name of at most
+    5 characters (the transcripts reported in the tx file).
     UID is best used due to duplicate transcript IDs in some annotations.
-    :param tx_dict: Transcript dictionary
+    :param transcriptome: Transcriptome
     :return: parameters_df: Dataframe of parameters
     """
-    parameters = []
-    parameter_list = ['Tx_ID', 'ATG', 'Stop', 'Length', 'FirstSpliceSite', 'LastSpliceSite', 'UID']
-    for tx_class in tx_dict:
-        for tx in tx_dict[tx_class]:
-            if len(tx.chrom)<=5:
-                starts = sorted(tx.trans_starts)
-                if len(starts) > 1 and tx.ctis > 0:   # Check if transcript is spliced and coding
-                    par = {'Tx_ID': tx.id,
-                           'ATG': tx.ctis,
-                           'Stop': tx.stop,
-                           'Length': len(tx),
-                           'FirstSpliceSite': starts[1],
-                           'LastSpliceSite': starts[-1],
-                           'UID': tx.uid}
-                elif len(starts) > 1:   # Transcript is spliced but not coding
-                    par = {'Tx_ID': tx.id,
-                           'ATG': '-1',
-                           'Stop': '-1',
-                           'Length': len(tx),
-                           'FirstSpliceSite': starts[1],
-                           'LastSpliceSite': starts[-1],
-                           'UID': tx.uid}
-                elif tx.ctis > 0:   # Transcript is coding but not spliced
-                    par = {'Tx_ID': tx.id,
-                           'ATG': tx.ctis,
-                           'Stop': tx.stop,
-                           'Length': len(tx),
-                           'FirstSpliceSite': '-1',
-                           'LastSpliceSite': '-1',
-                           'UID': tx.uid}
-                else:   # Transcript is non-coding and not spliced
-                    par = {'Tx_ID': tx.id,
-                           'ATG': '-1',
-                           'Stop': '-1',
-                           'Length': len(tx),
-                           'FirstSpliceSite': '-1',
-                           'LastSpliceSite': '-1',
-                           'UID': tx.uid}
-                parameters.append([par[parm] for parm in parameter_list])
-    parameters_df = pd.DataFrame(parameters)
-    parameters_df.columns = [parm for parm in parameter_list]
+    tm = transcriptome
+    tx = np.flatnonzero(np.char.str_len(tm.chroms) <= 5)
+    parameters_df = pd.DataFrame({'Tx_ID': tm.tx_ids[tx], **transcript_parameters(tm, tx),
+                                  'UID': tm.uids[tx]})
     return parameters_df
 
 
-def gen2tr(bedfile, tx_dict):
-    """
-    This function takes a genomic bed file and a dictionary of transcripts (of class Transcript),
-    intersects the bed file with the transcripts using bedtools intersect and outputs the
-    transcriptomic coordinates of the bed features into a file name of choice
-    """
-    print("---Building temporary conversion BED file...", end=" ")
-    with tempfile.NamedTemporaryFile(mode='w', delete=False) as temp_bed_key:
-        for tx_class in tx_dict:
-            if len(tx_dict[tx_class]) == 1:  # Check that this is an isoform without duplicates
-                for tx in tx_dict[tx_class]:
-                    for exon_start, exon_end, tr_exon_st, tr_exon_end in \
-                        zip(tx.genomic_starts, tx.genomic_ends,
-                            tx.trans_starts, tx.trans_ends):
-                        print(tx.chrom, exon_start, exon_end, "*", "*",
-                              tx.strand, tx.uid, tr_exon_st, tr_exon_end,
-                              sep="\t", file=temp_bed_key)
-        temp_bed_key.seek(0)
-        print("Done!")
-        print("---Intersecting BED files...", end=" ")
-        intersection = subprocess.Popen(['bedtools', 'intersect', '-a',
-                                         bedfile, '-b', temp_bed_key.name,
-                                         '-wo'], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        exon_limited_peaks = subprocess.Popen(['bedtools', 'intersect', '-a',
-                                               bedfile, '-b', temp_bed_key.name,
-                                               '-f', '0.5'], stdout=subprocess.PIPE)
-        print("Done!")
-        print("---Sorting, merging and outputting exon-limited peaks to file...", end=" ")
-        sorted_elp = subprocess.Popen(['bedtools', 'sort', '-i'],
-                                      stdin=exon_limited_peaks.stdout,
-                                      stdout=subprocess.PIPE)
-        merged_elp = subprocess.Popen(['bedtools', 'merge', '-nms', '-i'],
-                                      stdin=sorted_elp.stdout,
-                                      stdout=subprocess.PIPE)
-        with open(args.output+'_exonpeaks.bed', 'w') as exon_peak_output:
-            for l in merged_elp.stdout:
-                print(l.decode().strip(), file=exon_peak_output)
-        print("Done!")
-#    a = pd.read_csv(intersection.stdout, header=None, sep='\t')
-#    a.to_csv('intersection.log', sep='\t', header=False, index=False)
-    print("---Creating transcriptomic coordinates output...", end=" ")
-    with tempfile.NamedTemporaryFile(mode='w', delete=False) as temp_tr_bed:
-        for line in intersection.stdout:
-            myline = line.decode().strip().split()
-            p_start = int(myline[1])
-            p_end = int(myline[2])
-            peak_id = myline[3]
-            ex_st = int(myline[-9])
-            ex_end = int(myline[-8])
-            strand = myline[-5]
-            uid = myline[-4]
-            tr_exon_start = int(myline[-3])
-            overlap = int(myline[-1])
-            if strand == "+":
-                if p_start <= ex_st:
-                    print(uid, tr_exon_start, tr_exon_start+overlap, peak_id,
-                          sep="\t", file=temp_tr_bed)
-                elif p_start > ex_st:
-                    gap = p_start - ex_st
-                    print(uid, tr_exon_start+gap, tr_exon_start+gap+overlap, peak_id,
-                          sep="\t", file=temp_tr_bed)
-            elif strand == "-":
-                if p_end >= ex_end:
-                    print(uid, tr_exon_start, tr_exon_start+overlap, peak_id,
-                          sep="\t", file=temp_tr_bed)
-                elif p_end < ex_end:
-                    gap = ex_end - p_end
-                    print(uid, tr_exon_start+gap, tr_exon_start+gap+overlap, peak_id,
-                          sep="\t", file=temp_tr_bed)
-        temp_tr_bed.seek(0)
-        sorted_bed = subprocess.Popen(['bedtools', 'sort', '-i', temp_tr_bed.name],
-                                      stdout=subprocess.PIPE)
-        merged_bed = subprocess.Popen(['bedtools', 'merge', '-nms', '-d', '10', '-i'],
-                                      stdin=sorted_bed.stdout, stdout=subprocess.PIPE)
-        trdf = pd.read_csv(merged_bed.stdout, header=None, sep='\t')
-        trdf.columns = ['UID', 'Peak_Start', 'Peak_End', 'Peak_Names']
-        print("Done!")
-        return trdf
+def open_input(file_name):
+    """
+    This function opens an input file (BED, table or expression file) for reading
+    as text. Gzip and bgzip compressed files are recognized by their content and
+    decompressed while they are read, on a separate thread with python-isal if it
+    is installed.
+    """
+    with open(file_name, 'rb') as opened_file:
+        compressed = opened_file.read(2) == b'\x1f\x8b'
+    if not compressed:
+        return open(file_name, 'r')
+    if igzip_threaded is not None:
+        return igzip_threaded.open(file_name, 'rt', threads=1)
+    return gzip.open(file_name, 'rt')
+
+
+BED_HEADER_PREFIXES = ('#', 'track', 'browser')   # Lines skipped when reading BED files
+
+
+def count_bed_header_lines(opened_bed):
+    """
+    This function takes a BED file opened for reading (see open_input), reads past
+    the header lines (track, browser and comment lines) at its top and returns
+    their number, to be skipped by pd.read_csv, which would otherwise take the
+    number of columns from the first header line.
+    """
+    header_lines = 0
+    for line in opened_bed:
+        if not line.startswith(BED_HEADER_PREFIXES):
+            break
+        header_lines += 1
+    return header_lines
+
+
+@contextlib.contextmanager
+def open_bed(bedfile):
+    """
+    This function opens a BED file for reading (see open_input) and yields it
+    together with the number of header lines at its top (see count_bed_header_lines).
+    """
+    with open_input(bedfile) as opened_bed:
+        header_lines = count_bed_header_lines(opened_bed)
+    with open_input(bedfile) as opened_bed:
+        yield opened_bed, header_lines
+
+
+def format_bed_dataframe(bed):
+    """
+    This function takes a dataframe of the first four columns of a BED file read as
+    strings, drops header lines (track, browser and comment lines) and returns it
+    with the columns Chrom, Start, End and Name and integer coordinates.
+    """
+    bed.columns = ['Chrom', 'Start', 'End', 'Name']
+    header = bed.Chrom.str.startswith(BED_HEADER_PREFIXES)
+    if header.any():
+        bed = bed[~header].reset_index(drop=True)
+    try:
+        bed['Start'] = bed.Start.astype(np.int64)
+        bed['End'] = bed.End.astype(np.int64)
+    except (ValueError, TypeError):
+        raise PeakConverterError(BED_FORMAT_ERROR)
+    return bed
+
+
+def iter_bed_chunks(bedfile, chunksize=None):
+    """
+    This function reads a BED file (see read_bed_into_dataframe) and yields it as
+    dataframes of chunksize lines (a single dataframe if chunksize is None) with
+    the columns Chrom, Start, End and Name, in file order. An empty file yields
+    nothing. A file that is not a BED file raises PeakConverterError.
+    """
+    try:
+        with open_bed(bedfile) as (opened_bed, header_lines):
+            try:
+                chunks = pd.read_csv(opened_bed, sep='\t', header=None, usecols=[0, 1, 2, 3], dtype=str,
+                                     skiprows=header_lines, chunksize=chunksize)
+            except pd.errors.EmptyDataError:
+                return
+            for chunk in [chunks] if chunksize is None else chunks:
+                yield format_bed_dataframe(chunk)
+    except ValueError:   # Too few columns or lines pandas cannot parse
+        raise PeakConverterError(BED_FORMAT_ERROR)
+
+
+def concat_bed_chunks(chunks):
+    """
+    This function concatenates the dataframes yielded by iter_bed_chunks into one,
+    which has the columns Chrom, Start, End and Name even if there are no chunks.
+    """
+    if not chunks:
+        return format_bed_dataframe(pd.DataFrame({column: pd.Series(dtype=str) for column in range(4)}))
+    return pd.concat(chunks, ignore_index=True) if len(chunks) > 1 else chunks[0]
+
+
+def read_bed_into_dataframe(bedfile):
+    """
+    This function takes a BED file of genomic coordinates with an ID/name 4th column
+    and returns a pandas dataframe with the columns Chrom, Start, End and Name, in
+    file order. Header lines (track, browser and comment lines) are skipped.
+    """
+    return concat_bed_chunks(list(iter_bed_chunks(bedfile)))
+
+
+def iter_bed_chromosomes(bedfile, chunksize=1000000):
+    """
+    This function reads a BED file in chunks of chunksize lines and yields
+    (chromosome, peaks dataframe) pairs, one per chromosome, so that only one
+    chromosome's peaks are held in memory at a time. The file must be grouped by
+    chromosome (as MACS2 output and sort -k1,1 -k2,2n output are).
+    """
+    finished = set()
+    current, parts = None, []
+    for chunk in iter_bed_chunks(bedfile, chunksize):
+        if len(chunk) == 0:   # Only header lines
+            continue
+        chroms = chunk.Chrom.values
+        bounds = np.concatenate(([0], np.flatnonzero(chroms[1:] != chroms[:-1]) + 1, [len(chunk)]))
+        for run_start, run_end in zip(bounds[:-1], bounds[1:]):
+            chrom = chroms[run_start]
+            if chrom != current:
+                if parts:
+                    yield current, pd.concat(parts, ignore_index=True)
+                finished.add(current)
+                if chrom in finished:
+                    raise PeakConverterError("The BED file is not grouped by chromosome ("+str(chrom)+
+                                             " appears twice).\nPlease sort it (sort -k1,1 -k2,2n) "
+                                             "before using streaming mode.")
+                current, parts = chrom, []
+            parts.append(chunk.iloc[run_start:run_end])
+    if parts:
+        yield current, pd.concat(parts, ignore_index=True)
+
+
+class BedChunkReader:
+    """
+    Reads a BED file (see read_bed_into_dataframe) in chunks of chunksize lines on a
+    background thread that starts as soon as the reader is created, so that peaks
+    are parsed while the annotation and expression files are loaded and while
+    earlier chunks are intersected. Iterating over the reader yields the chunks in
+    file order as they are parsed, and raises any error of the reading thread.
+    A reader can be iterated over once. The reading is recorded as the background
+    stage read_bed of metrics (see Metrics.stage).
+    """
+    def __init__(self, bedfile, chunksize=1000000, metrics=None):
+        self.bedfile = bedfile
+        self.metrics = metrics or Metrics(0)
+        self.chunks = queue.Queue()
+        self.closed = threading.Event()
+        self.thread = threading.Thread(target=self.read, args=(chunksize,), daemon=True)
+        self.thread.start()
+
+    def read(self, chunksize):
+        """
+        This class function runs on the reading thread and queues the parsed chunks,
+        followed by None (or by the error that stopped it).
+        """
+        try:
+            with self.metrics.stage('read_bed', background=True) as counts:
+                counts['peaks'] = 0
+                for chunk in iter_bed_chunks(self.bedfile, chunksize):
+                    if self.closed.is_set():
+                        break
+                    counts['peaks'] += len(chunk)
+                    self.chunks.put(chunk)
+        except Exception as e:
+            self.chunks.put(e)
+        self.chunks.put(None)
+
+    def __iter__(self):
+        while True:
+            chunk = self.chunks.get()
+            if chunk is None:
+                return
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield chunk
+
+    def dataframe(self):
+        """
+        This class function waits for the whole file and returns it as one dataframe,
+        like read_bed_into_dataframe.
+        """
+        return concat_bed_chunks(list(self))
+
+    def close(self):
+        """
+        This class function stops the reading thread after its current chunk.
+        """
+        self.closed.set()
+
+
+class ExonIndex:
+    """
+    A per-chromosome index of exons for in-memory interval intersection.
+    Exons are kept as flat NumPy arrays (in the order they were given). Exons
+    shared by several transcripts are indexed once as a single genomic interval
+    and fanned out to every exon with the same coordinates after intersection,
+    so the cost of intersecting scales with the number of distinct exons rather
+    than with isoforms times exons. For every chromosome the distinct intervals
+    are split into length classes (powers of two) that are sorted by start.
+    Within a length class the longest interval bounds how far back a binary
+    search has to look, so every peak is matched with a pair of searchsorted calls.
+    """
+    def __init__(self, chroms, starts, ends, strands, uids, tr_starts):
+        self.chroms = np.asarray(chroms)
+        self.starts = np.asarray(starts, dtype=np.int64)
+        self.ends = np.asarray(ends, dtype=np.int64)
+        self.minus = np.asarray(strands) == "-"
+        self.uids = np.asarray(uids, dtype=np.int64)
+        self.tr_starts = np.asarray(tr_starts, dtype=np.int64)
+        chrom_codes = pd.factorize(self.chroms)[0]
+        fanout = np.lexsort((np.arange(len(self.starts)), self.ends, self.starts, chrom_codes))
+        distinct = np.ones(len(fanout), dtype=bool)
+        distinct[1:] = ((chrom_codes[fanout[1:]] != chrom_codes[fanout[:-1]]) |
+                        (self.starts[fanout[1:]] != self.starts[fanout[:-1]]) |
+                        (self.ends[fanout[1:]] != self.ends[fanout[:-1]]))
+        self.fanout = fanout   # Exons grouped by distinct interval
+        self.fanout_offsets = np.append(np.flatnonzero(distinct), len(fanout))
+        intervals = fanout[distinct]   # First exon of every distinct interval
+        self.chrom_bins = {}   # Chromosome -> list of (sorted starts, interval indices, longest interval)
+        self.chrom_exons = {}   # Chromosome -> exon indices, in the order they were given
+        length_class = np.log2(np.maximum(self.ends[intervals] - self.starts[intervals], 1)).astype(np.int64)
+        exon_bounds = np.flatnonzero(np.diff(chrom_codes[fanout])) + 1   # fanout is sorted by chromosome first
+        interval_bounds = np.flatnonzero(np.diff(chrom_codes[intervals])) + 1
+        for exons, on_chrom in zip(np.split(fanout, exon_bounds),
+                                   np.split(np.arange(len(intervals)), interval_bounds)):
+            if len(exons) == 0:
+                continue
+            chrom = self.chroms[exons[0]]
+            self.chrom_exons[chrom] = np.sort(exons)
+            bins = []
+            for cls in np.unique(length_class[on_chrom]):
+                members = on_chrom[length_class[on_chrom] == cls]
+                members = members[np.argsort(self.starts[intervals[members]], kind='stable')]
+                longest = int((self.ends[intervals[members]] - self.starts[intervals[members]]).max())
+                bins.append((self.starts[intervals[members]], members, longest))
+            self.chrom_bins[chrom] = bins
+        self.interval_ends = self.ends[intervals]
+
+    @classmethod
+    def from_transcriptome(cls, transcriptome, selected=None):
+        """
+        This class function builds an exon index from a Transcriptome, optionally
+        limited to the transcripts marked in the boolean array selected.
+        """
+        tm = transcriptome
+        exons = np.ones(len(tm.exon_starts), dtype=bool) if selected is None else selected[tm.exon_tx]
+        owner = tm.exon_tx[exons]
+        return cls(tm.chroms[owner], tm.exon_starts[exons], tm.exon_ends[exons],
+                   tm.strands[owner], tm.uids[owner], tm.tr_exon_starts[exons])
+
+    def overlaps(self, chrom, p_starts, p_ends):
+        """
+        This class function takes a chromosome and arrays of peak starts and ends on
+        it and returns two arrays (peak index, exon index) with one entry for every
+        peak-exon pair overlapping by at least one base, ordered by peak and then by
+        exon, like bedtools intersect output.
+        """
+        peak_hits, exon_hits = [], []
+        for bin_starts, members, longest in self.chrom_bins.get(chrom, []):
+            lo = np.searchsorted(bin_starts, p_starts - longest, side='right')
+            hi = np.searchsorted(bin_starts, p_ends, side='left')
+            counts = np.maximum(hi - lo, 0)
+            total = int(counts.sum())
+            if total == 0:
+                continue
+            peak_idx = np.repeat(np.arange(len(p_starts)), counts)
+            within = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+            interval_idx = members[np.repeat(lo, counts) + within]
+            keep = self.interval_ends[interval_idx] > p_starts[peak_idx]
+            peak_hits.append(peak_idx[keep])
+            exon_hits.append(interval_idx[keep])
+        if not peak_hits:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        peak_idx = np.concatenate(peak_hits)
+        interval_idx = np.concatenate(exon_hits)
+        first = self.fanout_offsets[interval_idx]   # Fan every hit out to the exons sharing the interval
+        counts = self.fanout_offsets[interval_idx + 1] - first
+        within = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        exon_idx = self.fanout[np.repeat(first, counts) + within]
+        peak_idx = np.repeat(peak_idx, counts)
+        order = np.lexsort((exon_idx, peak_idx))
+        return peak_idx[order], exon_idx[order]
+
+    def intersect(self, peaks, min_fraction=0.5):
+        """
+        This class function takes a peaks dataframe (see read_bed_into_dataframe) and
+        intersects it with the indexed exons in a single pass. It returns two dataframes:
+        the peak segments in transcriptomic coordinates (UID, Start, End, Name) and the
+        exon-limited peak segments in genomic coordinates (Chrom, Start, End, Name) of
+        peaks overlapping an exon by at least min_fraction of their length.
+        """
+        tr_parts, elp_parts = [], []
+        for chrom, chrom_peaks in peaks.groupby('Chrom', sort=False):
+            p_starts = chrom_peaks.Start.values
+            p_ends = chrom_peaks.End.values
+            peak_idx, exon_idx, seg_st, seg_end, tr_st = self.segments(chrom, p_starts, p_ends)
+            if len(peak_idx) == 0:
+                continue
+            tr_part, elp_part = segment_dataframes(chrom, chrom_peaks, self.uids[exon_idx], peak_idx,
+                                                   seg_st, seg_end, tr_st, min_fraction)
+            tr_parts.append(tr_part)
+            elp_parts.append(elp_part)
+        return concat_segments(tr_parts, elp_parts)
+
+    def subset(self, selected):
+        """
+        This class function takes a boolean array over the indexed exons (or an array
+        of exon indices) and returns a new ExonIndex of the selected exons.
+        """
+        return ExonIndex(self.chroms[selected], self.starts[selected], self.ends[selected],
+                         np.where(self.minus[selected], "-", "+"), self.uids[selected],
+                         self.tr_starts[selected])
+
+    def segments(self, chrom, p_starts, p_ends):
+        """
+        This class function takes a chromosome and arrays of peak starts and ends on
+        it and returns, for every overlapping peak-exon pair (see overlaps), the peak
+        index, the exon index, the genomic start and end of the overlap and its
+        transcriptomic start.
+        """
+        peak_idx, exon_idx = self.overlaps(chrom, p_starts, p_ends)
+        ex_st = self.starts[exon_idx]
+        ex_end = self.ends[exon_idx]
+        seg_st = np.maximum(p_starts[peak_idx], ex_st)
+        seg_end = np.minimum(p_ends[peak_idx], ex_end)
+        gap = np.where(self.minus[exon_idx], ex_end - seg_end, seg_st - ex_st)
+        return peak_idx, exon_idx, seg_st, seg_end, self.tr_starts[exon_idx] + gap
+
+
+def segment_dataframes(chrom, chrom_peaks, uids, peak_idx, seg_st, seg_end, tr_st, min_fraction=0.5):
+    """
+    This function takes the peak-exon overlaps of one chromosome (see
+    ExonIndex.segments) and returns the transcriptomic peak segments (UID, Start,
+    End, Name) and the exon-limited peak segments (Chrom, Start, End, Name) of peaks
+    overlapping an exon by at least min_fraction of their length.
+    """
+    names = chrom_peaks.Name.values[peak_idx]
+    overlap = seg_end - seg_st
+    tr_df = pd.DataFrame({'UID': uids, 'Start': tr_st, 'End': tr_st + overlap, 'Name': names})
+    limited = overlap >= min_fraction * (chrom_peaks.End.values[peak_idx] -
+                                         chrom_peaks.Start.values[peak_idx])
+    elp_df = pd.DataFrame({'Chrom': chrom, 'Start': seg_st[limited], 'End': seg_end[limited],
+                           'Name': names[limited]})
+    return tr_df, elp_df
+
+
+def concat_segments(tr_parts, elp_parts):
+    """
+    This function concatenates per-chromosome segment dataframes (see
+    segment_dataframes) into one transcriptomic and one exon-limited dataframe.
+    """
+    tr_df = pd.concat(tr_parts, ignore_index=True) if tr_parts else \
+        pd.DataFrame(columns=['UID', 'Start', 'End', 'Name'])
+    elp_df = pd.concat(elp_parts, ignore_index=True) if elp_parts else \
+        pd.DataFrame(columns=['Chrom', 'Start', 'End', 'Name'])
+    return tr_df, elp_df
+
+
+def merge_intervals(keys, starts, ends, names, distance=0):
+    """
+    This function sorts intervals by key (chromosome or transcript UID) and start
+    and merges intervals of the same key that overlap or lie at most distance bases
+    apart, like bedtools sort | bedtools merge -nms -d. The names of merged intervals
+    are collapsed with ";" in sorted order. It takes and returns NumPy arrays
+    (keys, starts, ends, names) and never leaves the process.
+    """
+    if len(starts) == 0:
+        return keys[:0], starts[:0], ends[:0], np.asarray(names, dtype=object)[:0]
+    unique_keys, key_codes = np.unique(keys, return_inverse=True)
+    order = np.lexsort((starts, key_codes))
+    key_codes = key_codes[order]
+    starts = np.asarray(starts, dtype=np.int64)[order]
+    ends = np.asarray(ends, dtype=np.int64)[order]
+    key_shift = np.int64(1) << 40   # Keeps running ends of different keys apart
+    reach = np.maximum.accumulate(key_codes * key_shift + ends)
+    new_interval = np.ones(len(starts), dtype=bool)
+    new_interval[1:] = key_codes[1:] * key_shift + starts[1:] - reach[:-1] > distance
+    first = np.flatnonzero(new_interval)
+    merged_names = np.add.reduceat(np.asarray(names, dtype=object)[order] + ';', first)
+    merged_names = np.array([name[:-1] for name in merged_names], dtype=object)
+    return (unique_keys[key_codes[first]], starts[first],
+            np.maximum.reduceat(ends, first), merged_names)
+
+
+def sort_merge_intervals(intervals, distance=0):
+    """
+    This function takes a dataframe of BED intervals (chrom/key, start, end, name),
+    sorts and merges them with merge_intervals and returns the merged intervals as
+    a dataframe with the same four columns.
+    """
+    key, start, end, name = intervals.columns
+    merged = merge_intervals(intervals[key].values, intervals[start].values,
+                             intervals[end].values, intervals[name].values, distance)
+    return pd.DataFrame(dict(zip(intervals.columns, merged)))
+
+
+def peaks_dataframe(peaks):
+    """
+    This function takes peaks as a dataframe whose first four columns are chromosome,
+    start, end and name (like read_bed_into_dataframe output), or as a sequence of
+    four arrays in that order, and returns a dataframe with the columns Chrom, Start,
+    End and Name and integer coordinates.
+    """
+    if isinstance(peaks, pd.DataFrame):
+        if peaks.shape[1] < 4:
+            raise PeakConverterError("Peaks need chromosome, start, end and name columns.")
+        peaks = peaks.iloc[:, :4]
+    elif len(peaks) == 4:
+        peaks = pd.DataFrame(dict(zip(range(4), peaks)))
+    else:
+        raise PeakConverterError("Peaks need chromosome, start, end and name arrays.")
+    try:
+        peaks = pd.DataFrame({'Chrom': np.asarray(peaks.iloc[:, 0], dtype=str),
+                              'Start': np.asarray(peaks.iloc[:, 1], dtype=np.int64),
+                              'End': np.asarray(peaks.iloc[:, 2], dtype=np.int64),
+                              'Name': np.asarray(peaks.iloc[:, 3], dtype=object)})
+    except (ValueError, TypeError):
+        raise PeakConverterError("Peak starts and ends must be integers.")
+    if (peaks.End < peaks.Start).any():
+        raise PeakConverterError("Peaks must not end before they start.")
+    return peaks
+
+
+class Converter:
+    """
+    A reusable genomic to transcriptomic converter for one set of chosen isoforms.
+    The exon index and the transcript parameters are built once; convert() then
+    works on peaks held in memory and returns its results in memory, without
+    files, subprocesses or global state. A Converter is never modified after it is
+    built, so convert() can be called from several threads at once.
+    By default transcript IDs found more than once in the transcriptome are left
+    out. If isoform ranks (see rank_isoforms) are given, every transcript is
+    converted, keyed by its UID so that each locus of a duplicated transcript ID is
+    kept, and the tx rows are tagged with the RANK_COLUMNS.
+    """
+    def __init__(self, transcriptome, merge_distance=10, ranks=None):
+        self.transcriptome = transcriptome
+        self.merge_distance = merge_distance
+        self.exon_index = ExonIndex.from_transcriptome(
+            transcriptome, None if ranks is not None else
+            transcriptome.unique_mask())   # Isoforms without duplicates
+        self.tx_order = np.lexsort((transcriptome.uids, transcriptome.tx_ids))   # Tx ID, then UID
+        self.tx_rank = np.empty(len(transcriptome), dtype=np.int64)
+        self.tx_rank[self.tx_order] = np.arange(len(transcriptome))
+        self.uid_index = np.full(int(transcriptome.uids.max(initial=0)) + 1, -1, dtype=np.int64)
+        self.uid_index[transcriptome.uids] = np.arange(len(transcriptome))   # UID -> transcript
+        self.ranks = None
+        if ranks is not None:
+            ranks = ranks.drop_duplicates('Isoform').set_index('Isoform')
+            ranked = ranks.index.get_indexer(transcriptome.tx_ids)
+            self.ranks = {'Rank': np.where(ranked >= 0, ranks.Rank.values[ranked], 0),
+                          'Expression': np.where(ranked >= 0, ranks.Expression.values[ranked], np.nan)}
+
+    @classmethod
+    def from_expression(cls, annotation, expression, genes=None, merge_distance=10,
+                        isoforms=None):
+        """
+        This class function builds a Converter for the isoforms chosen from an
+        expression file or dataframe (see choose_selected_isoforms) out of an
+        annotation Transcriptome. If isoforms is given, the isoforms up to that rank
+        in every gene (all ranked isoforms if it is 0) are converted instead, at
+        every locus of their transcript IDs (see rank_isoforms).
+        """
+        if genes is None:
+            genes = annotation.gene_table()
+        return cls.from_ranks(annotation, rank_isoforms(expression, genes), merge_distance, isoforms)
+
+    @classmethod
+    def from_ranks(cls, annotation, ranks, merge_distance=10, isoforms=None):
+        """
+        This class function builds a Converter out of an annotation Transcriptome
+        for isoform ranks returned by rank_isoforms, choosing the isoforms as
+        from_expression does.
+        """
+        if isoforms is None:
+            return cls(annotation.select(ranks.Isoform.values[ranks.Rank.values == 1]),
+                       merge_distance)
+        if isoforms:
+            ranks = ranks[ranks.Rank.values <= isoforms]
+        return cls(annotation.select(ranks.Isoform.values), merge_distance, ranks)
+
+    def overlap(self, peaks):
+        """
+        This class function takes peaks (see peaks_dataframe) and returns their
+        unmerged transcriptomic and exon-limited segments (see ExonIndex.intersect).
+        """
+        return self.exon_index.intersect(peaks_dataframe(peaks))
+
+    def merge(self, tr_intervals, exon_limited_peaks):
+        """
+        This class function sorts and merges the segments returned by overlap and
+        returns the merged transcriptomic peaks (UID, Peak_Start, Peak_End,
+        Peak_Names) and the merged exon-limited peaks (Chrom, Start, End, Name).
+        Transcriptomic peaks are merged keyed by the rank of their transcript in
+        transcript ID order, so they come out sorted by transcript ID, UID and start.
+        """
+        tx = self.uid_index[np.asarray(tr_intervals.UID.values, dtype=np.int64)]
+        ranks, starts, ends, names = merge_intervals(self.tx_rank[tx], tr_intervals.Start.values,
+                                                     tr_intervals.End.values,
+                                                     tr_intervals.Name.values, self.merge_distance)
+        trdf = pd.DataFrame({'UID': self.transcriptome.uids[self.tx_order[ranks]],
+                             'Peak_Start': starts, 'Peak_End': ends, 'Peak_Names': names})
+        return trdf, sort_merge_intervals(exon_limited_peaks)
+
+    def add_parameters(self, trdf):
+        """
+        This class function takes merged transcriptomic peaks (see merge), drops
+        peaks of 50 nt or shorter and peaks on transcripts of chromosomes with names
+        longer than 5 characters, and returns the rows of the tx output file: the
+        transcript ID, the peak, its middle (rounded half to even, as it has always
+        been written to the tx file) and the transcript parameters (see
+        transcript_parameters), plus the RANK_COLUMNS if isoform ranks were given.
+        The parameters are computed only for transcripts with peaks, once per
+        transcript, and the rows keep the transcript ID order of merge.
+        """
+        tm = self.transcriptome
+        tx = self.uid_index[np.asarray(trdf.UID.values, dtype=np.int64)]
+        starts = np.asarray(trdf.Peak_Start.values, dtype=np.int64)
+        ends = np.asarray(trdf.Peak_End.values, dtype=np.int64)
+        keep = np.flatnonzero(((ends - starts) > 50) & (np.char.str_len(tm.chroms[tx]) <= 5))
+        tx, starts, ends = tx[keep], starts[keep], ends[keep]
+        first = np.flatnonzero(np.diff(tx, prepend=-1))   # One run of rows per transcript
+        run_lengths = np.diff(np.append(first, len(tx)))
+        rows = {'Tx_ID': tm.tx_ids[tx], 'Peak_Start': starts, 'Peak_End': ends,
+                'Peak_Names': trdf.Peak_Names.values[keep],
+                'Peak_Middle': np.rint((starts + ends) / 2).astype(np.int64)}
+        for column, values in transcript_parameters(tm, tx[first]).items():
+            rows[column] = np.repeat(values, run_lengths)
+        if self.ranks is not None:
+            rows['Rank'] = self.ranks['Rank'][tx]
+            rows['Expression'] = self.ranks['Expression'][tx]
+            rows['UID'] = tm.uids[tx]
+        return pd.DataFrame(rows)
+
+    def intersect(self, peaks):
+        """
+        This class function takes peaks (see peaks_dataframe) and returns the merged
+        transcriptomic peaks and the merged exon-limited peaks (see merge).
+        """
+        return self.merge(*self.overlap(peaks))
+
+    def convert(self, peaks):
+        """
+        This class function takes peaks (see peaks_dataframe) and returns the rows of
+        the tx output (see add_parameters) and the merged exon-limited peaks as two
+        dataframes.
+        """
+        trdf, merged_elp = self.intersect(peaks)
+        return self.add_parameters(trdf), merged_elp
+
+
+class ResultCache:
+    """
+    An on-disk cache of peak-exon overlaps for incremental re-conversion, kept in
+    cache_dir/<annotation hash> (see hash_file). Every chromosome's peaks are stored
+    under a digest of their coordinates and names, together with the overlaps of
+    every transcript (by UID) already intersected with them. A rerun with other
+    expression values only intersects the transcripts that were not chosen before,
+    and only chromosomes whose peaks changed are intersected again. The outputs are
+    rebuilt from the cached overlaps and are identical to an uncached conversion.
+    """
+    SEGMENT_COLUMNS = ['peak', 'uid', 'exon_start', 'seg_start', 'seg_end', 'tr_start']
+
+    def __init__(self, cache_dir, annotation_hash):
+        self.path = os.path.join(cache_dir, annotation_hash[:16])
+
+    @staticmethod
+    def digest(chrom, chrom_peaks):
+        """
+        This class function returns the digest of one chromosome's peaks.
+        """
+        digest = hashlib.sha256(('v'+str(RESULT_CACHE_VERSION)+'\t'+chrom+'\t').encode())
+        digest.update(np.ascontiguousarray(chrom_peaks.Start.values, dtype=np.int64).tobytes())
+        digest.update(np.ascontiguousarray(chrom_peaks.End.values, dtype=np.int64).tobytes())
+        digest.update('\0'.join(map(str, chrom_peaks.Name.values)).encode())
+        return digest.hexdigest()[:32]
+
+    def load(self, cache_file):
+        """
+        This class function returns the cached overlaps of one chromosome (the UIDs
+        intersected and the SEGMENT_COLUMNS), or empty arrays if there are none.
+        """
+        try:
+            with np.load(cache_file) as cached:
+                return {column: cached[column] for column in ['uids'] + self.SEGMENT_COLUMNS}
+        except (OSError, ValueError, KeyError):
+            return {column: np.zeros(0, dtype=np.int64) for column in ['uids'] + self.SEGMENT_COLUMNS}
+
+    def save(self, cache_file, cached):
+        """
+        This class function writes the overlaps of one chromosome, replacing the
+        cache file in a single step so that readers never see a partial file.
+        """
+        os.makedirs(self.path, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=self.path, suffix='.npz', delete=False) as temp_file:
+            np.savez(temp_file, **cached)
+        os.replace(temp_file.name, cache_file)
+
+    def overlap(self, converter, peaks, counts=None):
+        """
+        This class function is the cached version of Converter.overlap. It returns
+        the unmerged transcriptomic and exon-limited peak segments of the peaks on
+        the converter's transcripts, intersecting only the transcripts missing from
+        the cache. If a counts dictionary is given, the numbers of chromosomes,
+        chromosomes fully served from the cache and transcripts intersected are
+        added to it.
+        """
+        index = converter.exon_index
+        counts = {} if counts is None else counts
+        counts.update(chromosomes=0, cached_chromosomes=0, intersected_transcripts=0)
+        tr_parts, elp_parts = [], []
+        for chrom, chrom_peaks in peaks_dataframe(peaks).groupby('Chrom', sort=False):
+            on_chrom = index.chrom_exons.get(chrom, np.zeros(0, dtype=np.int64))
+            wanted = np.unique(index.uids[on_chrom])
+            cache_file = os.path.join(self.path, self.digest(chrom, chrom_peaks)+'.npz')
+            cached = self.load(cache_file)
+            missing = np.setdiff1d(wanted, cached['uids'])
+            counts['chromosomes'] += 1
+            counts['cached_chromosomes'] += len(missing) == 0
+            counts['intersected_transcripts'] += len(missing)
+            if len(missing):
+                missing_index = index.subset(on_chrom[np.isin(index.uids[on_chrom], missing)])
+                peak_idx, exon_idx, seg_st, seg_end, tr_st = missing_index.segments(
+                    chrom, chrom_peaks.Start.values, chrom_peaks.End.values)
+                new = {'uids': missing, 'peak': peak_idx, 'uid': missing_index.uids[exon_idx],
+                       'exon_start': missing_index.starts[exon_idx], 'seg_start': seg_st,
+                       'seg_end': seg_end, 'tr_start': tr_st}
+                cached = {column: np.concatenate((cached[column], new[column])) for column in cached}
+                self.save(cache_file, cached)
+            keep = np.isin(cached['uid'], wanted)
+            order = np.flatnonzero(keep)[np.lexsort((cached['exon_start'][keep], cached['uid'][keep],
+                                                     cached['peak'][keep]))]   # Peak, then exon order
+            if len(order) == 0:
+                continue
+            tr_part, elp_part = segment_dataframes(chrom, chrom_peaks, cached['uid'][order],
+                                                   cached['peak'][order], cached['seg_start'][order],
+                                                   cached['seg_end'][order], cached['tr_start'][order])
+            tr_parts.append(tr_part)
+            elp_parts.append(elp_part)
+        return concat_segments(tr_parts, elp_parts)
+
+
+PROFILE_COLUMNS = ['Peak_Middle', 'ATG', 'Stop', 'Length', 'FirstSpliceSite']   # Used by metagene_profiles
+RANK_COLUMNS = ['Rank', 'Expression', 'UID']   # Added to the tx rows when converting ranked isoforms
+OUTPUT_FORMATS = {'bed': '_tx.bed', 'parquet': '_tx.parquet', 'arrow': '_tx.arrow',
+                  'npz': '_tx.npz'}   # Output format of the tx rows -> output file suffix
+_stream_state = {}   # Converter and result cache shared with chromosome worker processes
+
+
+def _convert_chromosome(peaks):
+    """
+    This function converts the peaks of one chromosome in streaming mode. It returns
+    the final tx rows (see Converter.add_parameters), the merged exon-limited peaks
+    and the number of peaks.
+    """
+    converter = _stream_state['converter']
+    result_cache = _stream_state['result_cache']
+    segments = result_cache.overlap(converter, peaks) if result_cache else converter.overlap(peaks)
+    trdf, merged_elp = converter.merge(*segments)
+    return converter.add_parameters(trdf), merged_elp, len(peaks)
+
+
+def gen2tr_streaming(bedfile, converter, output_prefix, workers=1, profile_parts=None,
+                     counts=None, result_cache=None, output_format='bed'):
+    """
+    This function is the streaming version of convert_sample's conversion. It converts the peaks of one
+    chromosome at a time (see iter_bed_chromosomes) and appends the results to the
+    output_prefix_tx.bed and output_prefix_exonpeaks.bed files as it goes, so that
+    memory is bounded by the largest chromosome rather than by the whole peak set.
+    With more than one worker, chromosomes are converted in parallel processes and
+    written in input order. Rows are grouped by chromosome in the order chromosomes
+    appear in the BED file. If a profile_parts list is given, the PROFILE_COLUMNS of
+    every chromosome's tx rows are appended to it for metagene analysis. If a counts
+    dictionary is given, the numbers of chromosomes, peaks and exon-limited peaks are
+    added to it. With a ResultCache, the overlaps of every chromosome are read from
+    and added to the cache. With another output_format than bed (see write_tx_rows)
+    the tx rows are collected and written once all chromosomes are converted.
+    It returns the number of rows in the tx file.
+    """
+    _stream_state['converter'] = converter
+    _stream_state['result_cache'] = result_cache
+    rows = 0
+    counts = {} if counts is None else counts
+    counts.update(chromosomes=0, peaks=0, exon_peaks=0)
+    tx_parts = []   # Tx rows of every chromosome for binary output formats
+    with open(output_prefix+'_tx.bed', 'w') if output_format == 'bed' else \
+            contextlib.nullcontext() as tx_output, \
+            open(output_prefix+'_exonpeaks.bed', 'w') as exon_peak_output:
+        def write_chromosome(result):
+            merged, merged_elp, peaks = result
+            counts['chromosomes'] += 1
+            counts['peaks'] += peaks
+            counts['exon_peaks'] += len(merged_elp)
+            if tx_output:
+                write_tx_rows(merged, tx_output)
+            else:
+                tx_parts.append(merged)
+            merged_elp.to_csv(exon_peak_output, sep='\t', header=False, index=False)
+            if profile_parts is not None:
+                profile_parts.append(merged[PROFILE_COLUMNS])
+            return len(merged)
+
+        chromosomes = iter_bed_chromosomes(bedfile)
+        if workers > 1 and 'fork' in multiprocessing.get_all_start_methods():
+            pending = deque()
+            with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('fork')) as pool:
+                for chrom, peaks in chromosomes:
+                    pending.append(pool.submit(_convert_chromosome, peaks))
+                    if len(pending) >= 2 * workers:   # Bound the number of chromosomes in flight
+                        rows += write_chromosome(pending.popleft().result())
+                while pending:
+                    rows += write_chromosome(pending.popleft().result())
+        else:
+            for chrom, peaks in chromosomes:
+                rows += write_chromosome(_convert_chromosome(peaks))
+    if output_format != 'bed':
+        tx_rows = pd.concat(tx_parts, ignore_index=True) if tx_parts else \
+            converter.add_parameters(pd.DataFrame(columns=['UID', 'Peak_Start', 'Peak_End',
+                                                           'Peak_Names']))
+        write_tx_rows(tx_rows, output_prefix+OUTPUT_FORMATS[output_format], output_format)
+    return rows
+
+
+def tr2gen(features, transcriptome, counts=None):
+    """
+    This function takes a dataframe of features in transcriptomic coordinates (with
+    the columns Chrom, Start, End and Name as returned by read_bed_into_dataframe,
+    Chrom holding the transcript ID) and a Transcriptome, and projects the features
+    back to genomic coordinates. Features spanning exon junctions are split into
+    one block per exon. All features are converted at once by searching the
+    cumulative exon lengths of every transcript with searchsorted.
+    It returns the first ten BED12 columns as a dataframe (up to BlockCount) and a
+    dataframe of the Start (relative to the feature start) and Size of every block,
+    in feature order and ascending genomic order within a feature (see write_bed12).
+    Features on transcripts that are unknown or duplicated in the annotation, or
+    that lie outside their transcript, are skipped; features running past the
+    transcript ends are clipped to it. If a counts dictionary is given, the numbers
+    of skipped and clipped features are added to it.
+    """
+    tm = transcriptome
+    counts = {} if counts is None else counts
+    unique = np.flatnonzero(tm.unique_mask())
+    feature_tx, feature_tx_ids = pd.factorize(features.Chrom)   # Look every transcript ID up once
+    tx_index = pd.Index(tm.tx_ids[unique]).get_indexer(feature_tx_ids)[feature_tx]
+    known = tx_index >= 0
+    tx = unique[tx_index[known]]
+    f_starts = np.maximum(features.Start.values[known], 0)
+    f_ends = np.minimum(features.End.values[known], tm.lengths[tx])
+    inside = f_ends > f_starts
+    clipped = inside & ((f_starts != features.Start.values[known]) | (f_ends != features.End.values[known]))
+    tx, f_starts, f_ends = tx[inside], f_starts[inside], f_ends[inside]
+    names = features.Name.values[known][inside]
+    counts.update(skipped=len(features) - len(tx), clipped=int(clipped.sum()))
+    order = tm.transcript_order()   # Exons in transcript order, so transcriptomic starts ascend
+    key_shift = np.int64(1 << 32)
+    start_keys = tm.exon_tx[order] * key_shift + tm.tr_exon_starts[order]
+    end_keys = tm.exon_tx[order] * key_shift + tm.tr_exon_ends[order]
+    by_key = np.argsort(tx * key_shift + f_starts)   # Sorted queries make searchsorted cache friendly
+    first = np.empty(len(tx), dtype=np.int64)
+    last = np.empty(len(tx), dtype=np.int64)
+    first[by_key] = np.searchsorted(end_keys, tx[by_key] * key_shift + f_starts[by_key], side='right')
+    last[by_key] = np.searchsorted(start_keys, tx[by_key] * key_shift + f_ends[by_key], side='left') - 1
+    block_counts = last - first + 1
+    first_block = np.cumsum(block_counts) - block_counts
+    feature = np.repeat(np.arange(len(tx)), block_counts)
+    exon = order[np.repeat(first, block_counts) + np.arange(block_counts.sum()) -
+                 np.repeat(first_block, block_counts)]
+    tr_st = tm.tr_exon_starts[exon]
+    seg_st = np.maximum(f_starts[feature], tr_st) - tr_st
+    seg_end = np.minimum(f_ends[feature], tm.tr_exon_ends[exon]) - tr_st
+    minus = tm.minus[tx][feature]
+    block_st = np.where(minus, tm.exon_ends[exon] - seg_end, tm.exon_starts[exon] + seg_st)
+    block_end = np.where(minus, tm.exon_ends[exon] - seg_st, tm.exon_starts[exon] + seg_end)
+    reverse = minus & (block_counts[feature] > 1)   # Minus-strand blocks come in descending genomic order
+    within = np.arange(len(feature)) - first_block[feature]
+    block_order = np.where(reverse, first_block[feature] + block_counts[feature] - 1 - within,
+                           np.arange(len(feature)))
+    block_st, block_end = block_st[block_order], block_end[block_order]
+    chrom_start = block_st[first_block]
+    chrom_end = block_end[first_block + block_counts - 1]
+    chrom_codes, chroms = pd.factorize(tm.chroms)   # Categorical columns avoid a string per feature
+    strand_codes, strands = pd.factorize(tm.strands)
+    genomic = pd.DataFrame({'Chrom': pd.Categorical.from_codes(chrom_codes[tx], chroms),
+                            'Start': chrom_start, 'End': chrom_end, 'Name': names, 'Score': 0,
+                            'Strand': pd.Categorical.from_codes(strand_codes[tx], strands),
+                            'ThickStart': chrom_start, 'ThickEnd': chrom_end, 'ItemRgb': 0,
+                            'BlockCount': block_counts})
+    blocks = pd.DataFrame({'Start': block_st - np.repeat(chrom_start, block_counts),
+                           'Size': block_end - block_st})
+    return genomic, blocks
+
+
+def format_int_lists(values, counts):
+    """
+    This function takes an array of non-negative integers and the number of integers
+    in every (non-empty) list, and returns the lists as BED12 style strings
+    ("1,2,3,"), one per list. The text of all lists is built in one byte array,
+    one digit position at a time, and split into the lists at once.
+    """
+    values = np.asarray(values, dtype=np.int64)
+    digits = np.searchsorted(10 ** np.arange(1, 19, dtype=np.int64), values, side='right') + 1
+    last = np.zeros(len(values), dtype=bool)   # Last integer of every list, followed by a newline
+    last[np.cumsum(counts) - 1] = True
+    widths = digits + 1 + last
+    starts = np.cumsum(widths) - widths
+    text = np.full(int(widths.sum()), ord(','), dtype=np.uint8)
+    text[(starts + digits + 1)[last]] = ord('\n')
+    for power in range(int(digits.max()) if len(values) else 0):
+        more = np.flatnonzero(digits > power)
+        text[starts[more] + digits[more] - 1 - power] = values[more] // 10 ** power % 10 + ord('0')
+    return text.tobytes().decode('ascii').split('\n')[:-1]
+
+
+def write_bed12(genomic, blocks, output_file):
+    """
+    This function writes the features returned by tr2gen to a BED12 output file,
+    formatting the BlockSizes and BlockStarts columns from the numeric blocks.
+    """
+    genomic = genomic.assign(BlockSizes=format_int_lists(blocks.Size.values, genomic.BlockCount.values),
+                             BlockStarts=format_int_lists(blocks.Start.values, genomic.BlockCount.values))
+    genomic.to_csv(output_file, sep='\t', header=False, index=False)
 
 
 def get_user_arguments():
@@ -272,15 +1392,80 @@ def get_user_arguments():
     """
     import argparse
     parser = argparse.ArgumentParser()
-    parser.add_argument('--bed-file', action='store', dest='bedfile', required=True,
+    parser.add_argument('--bed-file', action='store', dest='bedfile',
                         help='Path to MACS2 Peaks file (Or other BED format peak file)')
     parser.add_argument('--table-file', action='store', dest='tablefile', required=True,
                         help='Path to Annotation Table file')
-    parser.add_argument('--output-prefix', action='store', dest='output', required=True,
+    parser.add_argument('--output-prefix', action='store', dest='output',
                         help='Prefix of output files')
-    parser.add_argument('--expression-file', action='store', dest='expfile', required=True,
-                        help='Path to cufflinks output isoforms.fpkm_tracking file')
-    return parser.parse_args()
+    parser.add_argument('--expression-file', action='store', dest='expfile',
+                        help='Path to isoform expression file: cufflinks isoforms.fpkm_tracking, '
+                             'salmon quant.sf, kallisto abundance.tsv or RSEM isoforms.results')
+    parser.add_argument('--annotation-cache', action='store', dest='cachedir', default=None,
+                        help='Directory of compiled annotation caches. The table file is compiled '
+                             'once into a memory-mapped binary index that later runs load instantly')
+    parser.add_argument('--manifest', action='store', dest='manifest', default=None,
+                        help='Batch mode: tab-separated file of peak file, expression file and '
+                             'output prefix rows, converted against a single loaded annotation')
+    parser.add_argument('--workers', action='store', dest='workers', type=int,
+                        default=os.cpu_count(),
+                        help='Number of worker processes in batch mode (default: number of CPUs)')
+    parser.add_argument('--merge-distance', action='store', dest='merge_distance', type=int,
+                        default=10,
+                        help='Merge transcriptomic peak segments at most this many bases apart '
+                             '(default: 10)')
+    parser.add_argument('--metagene', action='store_true', dest='metagene',
+                        help='Also write metagene, ATG window and first splice site window '
+                             'profiles to <output prefix>_metagene.tsv')
+    parser.add_argument('--stream', action='store_true', dest='stream',
+                        help='Convert the peaks one chromosome at a time and write the outputs '
+                             'incrementally (the BED file must be grouped by chromosome)')
+    parser.add_argument('--stream-workers', action='store', dest='stream_workers', type=int,
+                        default=1,
+                        help='Number of processes converting chromosomes in parallel in streaming mode')
+    parser.add_argument('--summary-file', action='store', dest='summary', default=None,
+                        help='Batch mode per-sample summary file (default: <manifest>_summary.tsv)')
+    parser.add_argument('--isoforms', action='store', dest='isoforms', default=None,
+                        type=lambda value: 0 if value == 'all' else int(value),
+                        help='Convert the peaks onto the top N isoforms of every gene by expression '
+                             '(or, with "all", every isoform of the expression file, including '
+                             'unexpressed ones), keeping every locus of duplicated transcript IDs. '
+                             'The tx file then also holds the rank, '
+                             'expression and UID of every isoform')
+    parser.add_argument('--result-cache', action='store', dest='resultcache', default=None,
+                        help='Directory of cached peak-exon overlaps. Reruns on the same peaks '
+                             'only intersect isoforms and chromosomes missing from the cache')
+    parser.add_argument('--output-format', action='store', dest='output_format', default='bed',
+                        choices=list(OUTPUT_FORMATS),
+                        help='Format of the transcriptomic output: tab-separated <output prefix>_tx.bed '
+                             '(default), or <output prefix>_tx.parquet, _tx.arrow or _tx.npz with '
+                             'named columns')
+    parser.add_argument('--quiet', action='store_const', dest='verbosity', const=0, default=1,
+                        help='Do not print progress messages')
+    parser.add_argument('--verbose', action='store_const', dest='verbosity', const=2,
+                        help='Also print the wall time, CPU time, peak memory and record counts '
+                             'of every stage')
+    parser.add_argument('--metrics-file', action='store', dest='metrics_file', default=None,
+                        help='Write the measurements of every stage to this JSON file')
+    parser.add_argument('--profile-stage', action='store', dest='profile_stage', default=None,
+                        choices=STAGES,
+                        help='Run this stage under cProfile and write its statistics to '
+                             '--profile-file (default: <output prefix>_<stage>.prof)')
+    parser.add_argument('--profile-file', action='store', dest='profile_file', default=None,
+                        help='Output file of the --profile-stage statistics')
+    parser.add_argument('--tr2gen', action='store_true', dest='tr2gen',
+                        help='Convert a BED file of transcriptomic coordinates (transcript ID in the '
+                             '1st column) back to genomic coordinates, written as BED12 to '
+                             '<output prefix>_genomic.bed. No expression file is needed')
+    args = parser.parse_args()
+    if args.isoforms is not None and args.isoforms < 0:
+        parser.error('--isoforms must be a positive number or "all"')
+    if args.tr2gen and not (args.bedfile and args.output):
+        parser.error('--bed-file and --output-prefix are required with --tr2gen')
+    if not args.tr2gen and not args.manifest and not (args.bedfile and args.expfile and args.output):
+        parser.error('--bed-file, --expression-file and --output-prefix are required '
+                     'unless a --manifest is given')
+    return args
 
 
 def read_table_into_array(table_file, selected_transcripts=None):
@@ -292,7 +1477,7 @@ def read_table_into_array(table_file, selected_transcripts=None):
     UID|Tx ID|Chrom|Strand|Tx Start|Tx End|CDS Start|CDS End|Exon Starts (List)|
     Exon Ends (List)|Gene ID
     """
-    with open(table_file, 'r') as opened_table_file:
+    with open_input(table_file) as opened_table_file:
         first_line = opened_table_file.readline().strip().split()
         id_counter = 1
         table_array = []
@@ -308,9 +1493,7 @@ def read_table_into_array(table_file, selected_transcripts=None):
                                            [exon_starts] + [exon_ends] + [split_line[11]])
                         id_counter += 1
             else:
-                print("The table file is not at the right format.")
-                print("Please remember only RefSeq/GENCODE/Ensemble annotations are supported.")
-                sys.exit(0)
+                raise PeakConverterError(TABLE_FORMAT_ERROR)
         else:
             if "bin" in first_line[0]:
                 for line in opened_table_file:
@@ -322,128 +1505,676 @@ def read_table_into_array(table_file, selected_transcripts=None):
                                        [exon_starts] + [exon_ends] + [split_line[11]])
                     id_counter += 1
             else:
-                print("The table file is not at the right format.")
-                print("Please remember only RefSeq/GENCODE/Ensemble annotations are supported.")
-                sys.exit(0)
+                raise PeakConverterError(TABLE_FORMAT_ERROR)
     return table_array
 
 
+def read_table_into_transcriptome(table_file, selected_transcripts=None):
+    """
+    This function takes a table file and a set of transcripts and loads the
+    selected transcripts (or all transcripts if no set is supplied) directly into
+    a columnar Transcriptome, parsing the exon lists of all rows at once.
+    UIDs are the 1-based row numbers of the transcripts in the table, so they are the
+    same whether or not a set of transcripts is supplied.
+    """
+    with open_input(table_file) as opened_table_file:
+        first_line = opened_table_file.readline().strip().split()
+        if not first_line or "bin" not in first_line[0]:
+            raise PeakConverterError(TABLE_FORMAT_ERROR)
+        table = pd.read_csv(opened_table_file, sep='\t', header=None,
+                            usecols=[1, 2, 3, 4, 5, 6, 7, 9, 10, 12],
+                            dtype={1: str, 2: str, 3: str, 4: np.int64, 5: np.int64, 6: np.int64,
+                                   7: np.int64, 9: str, 10: str, 12: str},
+                            keep_default_na=False, quoting=3)
+    table.columns = ['name', 'chrom', 'strand', 'txStart', 'txEnd', 'cdsStart', 'cdsEnd',
+                     'exonStarts', 'exonEnds', 'name2']
+    uids = np.arange(1, len(table) + 1)
+    if selected_transcripts:
+        selected = table.name.isin(selected_transcripts).values
+        table = table[selected]
+        uids = uids[selected]
+    exon_counts = table.exonStarts.str.count(',').values
+    exon_starts = np.fromstring(''.join(table.exonStarts.tolist()), dtype=np.int64, sep=',')
+    exon_ends = np.fromstring(''.join(table.exonEnds.tolist()), dtype=np.int64, sep=',')
+    return Transcriptome(uids, table.name.values, table.chrom.values,
+                         table.strand.values, table.txStart.values, table.txEnd.values,
+                         table.cdsStart.values, table.cdsEnd.values, table.name2.values,
+                         np.concatenate(([0], np.cumsum(exon_counts))), exon_starts, exon_ends)
+
+
+def hash_file(file_name):
+    """
+    This function returns the SHA-256 hex digest of a file's content.
+    """
+    digest = hashlib.sha256()
+    with open(file_name, 'rb') as opened_file:
+        for block in iter(lambda: opened_file.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def annotation_cache_is_valid(cache_path, table_hash):
+    """
+    This function returns True if cache_path holds a compiled annotation of the
+    current cache format version for the table with the content hash table_hash.
+    """
+    try:
+        with open(os.path.join(cache_path, 'meta.json')) as meta_file:
+            meta = json.load(meta_file)
+    except (OSError, ValueError):
+        return False
+    return meta.get('version') == ANNOTATION_CACHE_VERSION and meta.get('sha256') == table_hash
+
+
+def compile_annotation_cache(table_file, cache_path, table_hash):
+    """
+    This function parses a table file into a Transcriptome and saves all of its
+    columns as .npy files in cache_path, together with a meta.json file holding the
+    cache format version and the table's content hash. The cache is written to a
+    temporary directory first and then renamed into place, so that several
+    processes can compile the same cache at once: the first rename wins, the
+    others discard their copy and use the transcriptome they parsed. A stale cache
+    is renamed away before it is deleted, and a valid one is never deleted.
+    """
+    transcriptome = read_table_into_transcriptome(table_file)
+    temp_path = tempfile.mkdtemp(dir=os.path.dirname(cache_path), prefix='.tmp_')
+    try:
+        for column, values in transcriptome.columns().items():
+            np.save(os.path.join(temp_path, column + '.npy'), values)
+        with open(os.path.join(temp_path, 'meta.json'), 'w') as meta_file:
+            json.dump({'version': ANNOTATION_CACHE_VERSION, 'sha256': table_hash,
+                       'table_file': os.path.abspath(table_file),
+                       'transcripts': len(transcriptome)}, meta_file)
+        if os.path.isdir(cache_path) and not annotation_cache_is_valid(cache_path, table_hash):
+            stale_path = tempfile.mkdtemp(dir=os.path.dirname(cache_path), prefix='.tmp_')
+            try:
+                os.rename(cache_path, os.path.join(stale_path, 'stale'))
+            except OSError:   # Another process already moved it
+                pass
+            shutil.rmtree(stale_path, ignore_errors=True)
+        try:
+            os.rename(temp_path, cache_path)
+        except OSError:
+            if not os.path.isdir(cache_path):
+                raise   # Not a cache compiled meanwhile by another process
+    finally:
+        shutil.rmtree(temp_path, ignore_errors=True)
+    return transcriptome
+
+
+def load_annotation(table_file, cache_dir=None):
+    """
+    This function takes a table file and returns a Transcriptome of all of its
+    transcripts. If a cache directory is supplied, the compiled annotation is
+    memory-mapped from cache_dir/<table name>.<content hash>, and the cache is
+    (re)built first if it is missing, was written by another cache format version
+    or does not match the table's content.
+    """
+    if cache_dir is None:
+        return read_table_into_transcriptome(table_file)
+    table_hash = hash_file(table_file)
+    cache_path = os.path.join(cache_dir, os.path.basename(table_file) + '.' + table_hash[:16])
+    if not annotation_cache_is_valid(cache_path, table_hash):
+        os.makedirs(cache_dir, exist_ok=True)
+        return compile_annotation_cache(table_file, cache_path, table_hash)
+    columns = {}
+    for column in Transcriptome.TX_COLUMNS + Transcriptome.EXON_COLUMNS + ['exon_offsets']:
+        columns[column] = np.load(os.path.join(cache_path, column + '.npy'), mmap_mode='r')
+    return Transcriptome.from_columns(columns)
+
+
 def isoform_gene_dict(table_file):
     """
     This function receives a table file and returns a dictionary in which
     the keys are isoforms and the values are genes and coding info, for use in the
     choose_selected_cufflinks function.
     """
-    with open(table_file, 'r') as opened_table_file:
+    with open_input(table_file) as opened_table_file:
         first_line = opened_table_file.readline().strip().split()
         gene_dict = {}
         if "bin" in first_line[0]:
             for line in opened_table_file:
                 split_line = line.strip().split('\t')[1:]
-                if split_line[7] == split_line[6]:
+                if split_line[6] == split_line[5]:   # CDS start equals CDS end
                     gene_dict[split_line[0]] = (split_line[11], 0)
                 else:
                     gene_dict[split_line[0]] = (split_line[11], 1)
         else:
-            print("The table file is not at the right format.")
-            print("Please remember only RefSeq/GENCODE/Ensemble annotations are supported.")
-            sys.exit(0)
+            raise PeakConverterError(TABLE_FORMAT_ERROR)
     return gene_dict
 
 
-def choose_selected_cufflinks(input_file, table_file):
+EXPRESSION_FORMATS = {   # Format: (first header field, isoform column, length column, expression column)
+    'cufflinks': ('tracking_id', 3, 7, 9),   # isoforms.fpkm_tracking, FPKM
+    'salmon': ('Name', 'Name', 'Length', 'TPM'),   # quant.sf
+    'kallisto': ('target_id', 'target_id', 'length', 'tpm'),   # abundance.tsv
+    'rsem': ('transcript_id', 'transcript_id', 'length', 'TPM'),   # isoforms.results
+}
+
+
+def read_expression_file(input_file):
     """
-    This function receives a cufflinks output file isoforms.fpkm_tracking
-    and a UCSC table file.
-    It chooses the isoforms that will be used for genomic to transcriptomic
-    conversion in the following order:
-    1. Most expressed isoform of a gene by FPKM
+    This function receives an isoform expression file of one of the EXPRESSION_FORMATS
+    (Cufflinks isoforms.fpkm_tracking, Salmon quant.sf, kallisto abundance.tsv or RSEM
+    isoforms.results), detected from its header, and returns a dataframe with the
+    columns Isoform, Length and Expression (FPKM for Cufflinks, TPM otherwise).
+    Isoform names of GENCODE transcript FASTA headers (ENST...|ENSG...|...) are
+    trimmed to the transcript ID.
+    """
+    with open_input(input_file) as input_f:
+        header = input_f.readline().rstrip('\n').split('\t')
+        for name, (first_field, isoform, length, expression) in EXPRESSION_FORMATS.items():
+            if header[0] == first_field:
+                break
+        else:
+            raise PeakConverterError("The expression file is not at the right format.\n"
+                                     "Supported formats are: "+", ".join(EXPRESSION_FORMATS)+".")
+        if name != 'cufflinks':
+            if not {isoform, length, expression} <= set(header):
+                raise PeakConverterError("The "+name+" expression file lacks one of the columns "
+                                         + ", ".join([isoform, length, expression])+".")
+            isoform, length, expression = (header.index(isoform), header.index(length),
+                                           header.index(expression))
+        table = pd.read_csv(input_f, sep='\t', header=None, usecols=[isoform, length, expression],
+                            dtype={isoform: str}, keep_default_na=False, quoting=3)
+    expression_df = pd.DataFrame({'Isoform': table[isoform].str.split('|', n=1).str[0],
+                                  'Length': table[length].astype(np.int64),
+                                  'Expression': table[expression].astype(np.float64)})
+    return expression_df
+
+
+def rank_isoforms(input_file, genes):
+    """
+    This function receives an isoform expression file (see read_expression_file), or
+    a dataframe with its Isoform, Length and Expression columns, and a gene table
+    (see Transcriptome.gene_table).
+    It ranks the isoforms of every gene in the following order:
+    1. Most expressed isoform of a gene by FPKM/TPM
     2. Longest coding isoform.
     3. Longest isoform.
-    It returns a set of the chosen isoforms.
+    Remaining ties go to the isoform listed first in the expression file.
+    Isoforms missing from the gene table are dropped with a PeakConverterWarning
+    (more than 5 raise a PeakConverterError).
+    The expression table is joined to the gene table and all isoforms are ranked
+    with a single sort. It returns a dataframe with the columns Isoform, Gene, Rank
+    (1 for the chosen isoform of every gene) and Expression, ordered by gene and rank.
+    """
+    if isinstance(input_file, pd.DataFrame):
+        expression_df = input_file[['Isoform', 'Length', 'Expression']]
+    else:
+        expression_df = read_expression_file(input_file)
+    joined = expression_df.merge(genes, on='Isoform', how='left', sort=False)
+    missing = joined.Gene.isna().values
+    if missing.any():
+        not_found = "\n".join("Isoform "+str(isoform)+" was not found in table file."
+                             for isoform in joined.Isoform.values[missing][:6])
+        if missing.sum() > 5:
+            raise PeakConverterError(not_found+"\nOver 5 isoforms not found in table file. Aborting.\n"
+                                     "Are you sure you chose the same annotation for the "
+                                     "expression and table files?")
+        warnings.warn(not_found, PeakConverterWarning, stacklevel=2)
+        joined = joined[~missing]
+    gene_codes = pd.factorize(joined.Gene)[0]
+    order = np.lexsort((np.arange(len(joined)), -joined.Length.values,
+                        -joined.Coding.values.astype(np.int64), -joined.Expression.values,
+                        gene_codes))
+    sorted_genes = gene_codes[order]
+    first = np.concatenate(([True], sorted_genes[1:] != sorted_genes[:-1]))
+    gene_start = np.flatnonzero(first)
+    ranks = np.arange(len(order)) - np.repeat(gene_start, np.diff(np.append(gene_start, len(order)))) + 1
+    return pd.DataFrame({'Isoform': joined.Isoform.values[order], 'Gene': joined.Gene.values[order],
+                         'Rank': ranks, 'Expression': joined.Expression.values[order]})
+
+
+def choose_selected_isoforms(input_file, genes):
+    """
+    This function receives an isoform expression file, or a dataframe with its
+    Isoform, Length and Expression columns, and a gene table, and chooses the
+    isoforms that will be used for genomic to transcriptomic conversion: the top
+    ranked isoform of every gene (see rank_isoforms). It returns a set of the
+    chosen isoforms.
+    """
+    ranks = rank_isoforms(input_file, genes)
+    return set(ranks.Isoform.values[ranks.Rank.values == 1])
+
+
+def choose_selected_cufflinks(input_file, table_file):
+    """
+    This function receives a cufflinks output file isoforms.fpkm_tracking
+    (or any other supported expression file) and a UCSC table file and returns
+    the set of chosen isoforms (see choose_selected_isoforms).
     """
-    iso_dict = {}
-    ret_list = []
-    c = 0
     gene_dict = isoform_gene_dict(table_file)
-    with open(input_file, 'r') as input_f:
-        _ = input_f.readline()
-        for line in input_f:
-            fline = line.strip().split()
-            isoform = fline[3]
-            fpkm = float(fline[9])
-            txlength = int(fline[7])
-            if isoform in gene_dict:
-                gene = gene_dict[isoform][0]
-                coding = gene_dict[isoform][1]
-                if gene in iso_dict:
-                    if fpkm > iso_dict[gene][1]:
-                        iso_dict[gene] = (isoform, fpkm, txlength, coding)
-                    elif fpkm == iso_dict[gene][1] and coding == 1 \
-                            and iso_dict[gene][3] == 0:
-                        iso_dict[gene] = (isoform, fpkm, txlength, coding)
-                    elif fpkm == iso_dict[gene][1] and txlength > iso_dict[gene][2]:
-                        iso_dict[gene] = (isoform, fpkm, txlength, coding)
-                else:
-                    iso_dict[gene] = (isoform, fpkm, txlength, coding)
+    genes = pd.DataFrame({'Isoform': list(gene_dict),
+                          'Gene': [gene for gene, coding in gene_dict.values()],
+                          'Coding': [coding for gene, coding in gene_dict.values()]})
+    return choose_selected_isoforms(input_file, genes)
+
+
+def write_tx_rows(tx_rows, output_file, output_format='bed'):
+    """
+    This function writes tx rows (see Converter.add_parameters) to an output file
+    name or, for the bed format, an open file. Besides the tab-separated bed format, the rows can
+    be written with their column names as Parquet or Arrow (Feather) files, which
+    need pyarrow, or as a NumPy .npz archive with one array per column (see
+    OUTPUT_FORMATS). In the npz format every text column (such as Tx_ID and
+    Peak_Names) is stored as its UTF-8 bytes, concatenated into one uint8 array, and
+    an array column_offsets of the start and end of every value, so that long peak
+    name lists do not pad every row (see read_tx_npz).
+    """
+    if output_format == 'bed':
+        if 'Expression' in tx_rows:
+            tx_rows = tx_rows.assign(Expression=tx_rows.Expression.map(repr))
+        tx_rows.to_csv(output_file, sep='\t', header=False, index=False)
+    elif output_format == 'npz':
+        arrays = {}
+        for column in tx_rows.columns:
+            values = tx_rows[column]
+            if pd.api.types.is_numeric_dtype(values):
+                arrays[column] = values.to_numpy()
+                continue
+            values = values.astype(str)
+            encoded = "".join(values.tolist()).encode('utf-8')
+            lengths = values.str.len().to_numpy(dtype=np.int64)
+            if len(encoded) != lengths.sum():   # Non-ASCII text, count the bytes of every value
+                lengths = values.str.encode('utf-8').str.len().to_numpy(dtype=np.int64)
+            arrays[column] = np.frombuffer(encoded, dtype=np.uint8)
+            arrays[column+'_offsets'] = np.concatenate(([0], np.cumsum(lengths)))
+        np.savez(output_file, **arrays)
+    else:
+        try:
+            if output_format == 'parquet':
+                tx_rows.to_parquet(output_file, index=False)
             else:
-                print("Isoform "+str(isoform)+" was not found in table file.")
-                c+=1
-                if c > 5:
-                    print("Over 5 isoforms not found in table file. Aborting.")
-                    print("Are you sure you chose the same annotation for cufflinks and table file?")
-                    sys.exit(0)
-    for gene in iso_dict:
-        ret_list.append(iso_dict[gene][0])
-    return set(ret_list)
+                tx_rows.reset_index(drop=True).to_feather(output_file)
+        except ImportError:
+            raise PeakConverterError("The "+output_format+" output format needs pyarrow "
+                                     "(pip install pyarrow).")
 
 
-def check_dependencies():
+def read_tx_npz(npz_file):
     """
-    This function checks that the dependencies are defined in the system's PATH.
-    If not, it terminates the script.
+    This function reads tx rows written in the npz format (see write_tx_rows) and
+    returns them as a dataframe with the columns of the tx file.
     """
-    import shutil
-    if not shutil.which("bedtools"):
-        print("BEDtools not installed or not defined in PATH!")
-        sys.exit(0)
-    return
+    with np.load(npz_file) as archive:
+        arrays = {name: archive[name] for name in archive.files}
+    tx_rows = {}
+    for column, values in arrays.items():
+        if column.endswith('_offsets') and column[:-len('_offsets')] in arrays:
+            continue
+        offsets = arrays.get(column+'_offsets')
+        if offsets is None:
+            tx_rows[column] = values
+            continue
+        text = values.tobytes()
+        tx_rows[column] = [text[start:end].decode('utf-8') for start, end in zip(offsets[:-1], offsets[1:])]
+    return pd.DataFrame(tx_rows)
+
+
+def kde_on_grid(values, grid):
+    """
+    This function returns a Gaussian kernel density estimate of values evaluated at
+    the points of grid, with R's default bandwidth (bw.nrd0, as used by ggplot2's
+    geom_density). Values are first binned onto a fine regular grid, so the cost is
+    linear in the number of values.
+    """
+    values = values[np.isfinite(values)]
+    if len(values) < 2:
+        return np.zeros(len(grid))
+    spread = min(values.std(ddof=1), np.subtract(*np.percentile(values, [75, 25])) / 1.34)
+    if spread <= 0:
+        spread = values.std(ddof=1) or abs(values[0]) or 1
+    bandwidth = 0.9 * spread * len(values) ** -0.2
+    edges = np.linspace(values.min() - 3 * bandwidth, values.max() + 3 * bandwidth, 2049)
+    weights, _ = np.histogram(values, edges)
+    centers = (edges[:-1] + edges[1:]) / 2
+    kernel = np.exp(-0.5 * ((grid[:, None] - centers[None, :]) / bandwidth) ** 2)
+    return kernel @ weights / (len(values) * bandwidth * np.sqrt(2 * np.pi))
+
+
+def metagene_profiles(tx_rows, window=300, metagene_bins=100, window_bin=10):
+    """
+    This function takes rows of the tx output (with the columns Peak_Middle, ATG,
+    Stop, Length and FirstSpliceSite) and computes the profiles of metagene.R:
+    the peak middle position along a normalized 5'UTR/CDS/3'UTR metagene of coding
+    transcripts, and its distance from the canonical ATG and from the first splice
+    site within +-window nt. Every profile is binned and a kernel density estimate is
+    evaluated at the bin centers. It returns a dataframe with the columns Profile,
+    Bin_Start, Bin_End, Count and Density, and a dictionary of the normalized
+    metagene positions of the ATG and stop codon.
+    """
+    middle = tx_rows.Peak_Middle.values.astype(np.float64)
+    atg = tx_rows.ATG.values.astype(np.float64)
+    stop = tx_rows.Stop.values.astype(np.float64)
+    length = tx_rows.Length.values.astype(np.float64)
+    first_ss = tx_rows.FirstSpliceSite.values.astype(np.float64)
+    coding = atg > -1
+    utr5, cds, utr3 = atg[coding], stop[coding] - atg[coding], length[coding] - stop[coding]
+    mean_length = length[coding].mean() if coding.any() else 1
+    m5len, mcdslen, m3len = (utr5.mean() / mean_length, cds.mean() / mean_length,
+                             utr3.mean() / mean_length) if coding.any() else (0, 0, 0)
+    mid = middle[coding]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        norm_loc = np.where(mid < atg[coding], mid / utr5 * m5len,
+                            np.where(mid < stop[coding], (mid - atg[coding]) / cds * mcdslen + m5len,
+                                     (mid - stop[coding]) / utr3 * m3len + mcdslen + m5len))
+    atg_dist = mid - atg[coding]
+    ss_dist = middle[first_ss > -1] - first_ss[first_ss > -1]
+    profiles = [('Metagene', norm_loc[np.isfinite(norm_loc)], np.linspace(0, 1, metagene_bins + 1)),
+                ('ATG', atg_dist[np.abs(atg_dist) <= window],
+                 np.arange(-window, window + window_bin, window_bin)),
+                ('FirstSpliceSite', ss_dist[np.abs(ss_dist) <= window],
+                 np.arange(-window, window + window_bin, window_bin))]
+    tables = []
+    for name, values, edges in profiles:
+        counts, _ = np.histogram(values, edges)
+        tables.append(pd.DataFrame({'Profile': name, 'Bin_Start': edges[:-1], 'Bin_End': edges[1:],
+                                    'Count': counts,
+                                    'Density': kde_on_grid(values, (edges[:-1] + edges[1:]) / 2)}))
+    return pd.concat(tables, ignore_index=True), {'ATG': m5len, 'Stop': m5len + mcdslen}
+
+
+def write_metagene_profiles(tx_rows, output_file, window=300):
+    """
+    This function computes the metagene profiles of the tx rows (see
+    metagene_profiles) and writes them as a tab-separated table, preceded by a
+    comment line with the metagene positions of the ATG and stop codon.
+    """
+    profiles, landmarks = metagene_profiles(tx_rows, window)
+    with open(output_file, 'w') as profile_output:
+        print("# Metagene landmarks: ATG=%.6f Stop=%.6f" % (landmarks['ATG'], landmarks['Stop']),
+              file=profile_output)
+        profiles.to_csv(profile_output, sep='\t', index=False, float_format='%.6g')
+
+
+def convert_sample(annotation, bedfile, expfile, output_prefix, genes=None,
+                   stream=False, workers=1, merge_distance=10, metagene=False, isoforms=None,
+                   result_cache=None, output_format='bed', metrics=None):
+    """
+    This function runs the whole conversion of one sample against an already loaded
+    annotation (Transcriptome): it chooses the most expressed isoforms, converts the
+    peaks to transcriptomic coordinates and writes the output_prefix_tx.bed and
+    output_prefix_exonpeaks.bed files. With stream=True the peaks are converted one
+    chromosome at a time (see gen2tr_streaming). Transcriptomic peak segments at
+    most merge_distance bases apart are merged. With metagene=True the metagene
+    profiles are also written to output_prefix_metagene.tsv (see
+    write_metagene_profiles). Unless streaming, the peaks are parsed on a separate
+    thread (see BedChunkReader) while the isoforms are chosen, and every chunk of
+    peaks is intersected as soon as it is parsed; bedfile may also be an already
+    started BedChunkReader. expfile may be an expression file or dataframe (see
+    rank_isoforms). If isoforms is given, the top ranked isoforms of every
+    gene are converted instead of the most expressed one (see Converter.from_expression).
+    With a ResultCache only transcripts and chromosomes missing from the cache are
+    intersected. The tx rows are written in output_format (see write_tx_rows) to
+    output_prefix with the suffix of OUTPUT_FORMATS. Every stage is recorded in
+    metrics (see Metrics).
+    It returns the number of rows in the tx file.
+    """
+    metrics = metrics or Metrics()
+    peak_reader = None
+    if not stream:   # Parse the peaks while the isoforms are chosen
+        peak_reader = bedfile if isinstance(bedfile, BedChunkReader) else \
+            BedChunkReader(bedfile, metrics=metrics)
+    try:
+        if genes is None:
+            genes = annotation.gene_table()
+        with metrics.stage('choose_isoforms', "Choosing most expressed isoform for each gene") \
+                as counts:
+            with warnings.catch_warnings(record=True) as caught:
+                warnings.simplefilter('always', PeakConverterWarning)
+                ranks = rank_isoforms(expfile, genes)
+            counts['isoforms'] = len(ranks)
+        for warning in caught:
+            if issubclass(warning.category, PeakConverterWarning):
+                metrics.log(str(warning.message))
+            else:
+                warnings.warn_explicit(warning.message, warning.category, warning.filename, warning.lineno)
+        with metrics.stage('build_converter', "Building the converter") as counts:
+            converter = Converter.from_ranks(annotation, ranks, merge_distance, isoforms)
+            counts.update(transcripts=len(converter.transcriptome),
+                          exons=len(converter.transcriptome.exon_starts))
+    except BaseException:
+        if peak_reader:
+            peak_reader.close()
+        raise
+    if stream:
+        profile_parts = [] if metagene else None
+        with metrics.stage('stream', "Converting genomic to transcriptomic coordinates "
+                                     "one chromosome at a time") as counts:
+            rows = gen2tr_streaming(bedfile, converter, output_prefix, workers, profile_parts,
+                                    counts, result_cache, output_format)
+            counts['tx_rows'] = rows
+        if metagene:
+            with metrics.stage('metagene', "Computing metagene profiles") as counts:
+                profile_rows = pd.concat(profile_parts, ignore_index=True) if profile_parts else \
+                    pd.DataFrame(columns=PROFILE_COLUMNS)
+                write_metagene_profiles(profile_rows, output_prefix+'_metagene.tsv')
+                counts['peaks'] = len(profile_rows)
+        return rows
+    if result_cache:
+        peaks = peak_reader.dataframe()
+        metrics.show('read_bed')
+        with metrics.stage('intersect', "Intersecting peaks with exons") as counts:
+            tr_intervals, exon_limited_peaks = result_cache.overlap(converter, peaks, counts)
+            counts.update(peaks=len(peaks), tr_segments=len(tr_intervals),
+                          exon_segments=len(exon_limited_peaks))
+    else:
+        with metrics.stage('intersect', "Reading and intersecting peaks with exons") as counts:
+            tr_parts, elp_parts = [], []
+            counts['peaks'] = 0
+            for chunk in peak_reader:   # Intersected as soon as each chunk is parsed
+                tr_part, elp_part = converter.overlap(chunk)
+                tr_parts.append(tr_part)
+                elp_parts.append(elp_part)
+                counts['peaks'] += len(chunk)
+            tr_intervals, exon_limited_peaks = concat_segments(tr_parts, elp_parts)
+            counts.update(tr_segments=len(tr_intervals), exon_segments=len(exon_limited_peaks))
+        metrics.show('read_bed')
+    with metrics.stage('merge', "Sorting and merging intervals") as counts:
+        trdf, merged_elp = converter.merge(tr_intervals, exon_limited_peaks)
+        counts.update(tr_peaks=len(trdf), exon_peaks=len(merged_elp))
+    with metrics.stage('parameters', "Adding transcript parameters") as counts:
+        merged = converter.add_parameters(trdf)
+        counts['tx_rows'] = len(merged)
+    with metrics.stage('write', "Writing results to file") as counts:
+        merged_elp.to_csv(output_prefix+'_exonpeaks.bed', sep='\t', header=False, index=False)
+        write_tx_rows(merged, output_prefix+OUTPUT_FORMATS[output_format], output_format)
+        counts.update(tx_rows=len(merged), exon_peaks=len(merged_elp))
+    if metagene:
+        with metrics.stage('metagene', "Computing metagene profiles") as counts:
+            write_metagene_profiles(merged, output_prefix+'_metagene.tsv')
+            counts['peaks'] = len(merged)
+    return len(merged)
+
+
+def read_manifest(manifest_file):
+    """
+    This function reads a batch manifest, a tab-separated file in which every row
+    holds a peak file, an expression file and an output prefix. Empty lines and
+    lines starting with # are skipped. It returns a list of (bed, expression, prefix)
+    tuples.
+    """
+    samples = []
+    with open(manifest_file, 'r') as opened_manifest:
+        for line_number, line in enumerate(opened_manifest, 1):
+            if not line.strip() or line.startswith('#'):
+                continue
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) < 3:
+                raise PeakConverterError("Manifest line "+str(line_number)+
+                                         " does not have 3 tab-separated columns.")
+            samples.append(tuple(fields[:3]))
+    return samples
+
+
+_batch_state = {}   # Annotation, gene table and conversion options shared with batch workers
+
+
+def _init_batch_worker(annotation, genes, table_file, cache_dir, options, metric_options):
+    """
+    This function initializes a batch worker process. With the fork start method the
+    parent's annotation is inherited copy-on-write; otherwise it is loaded again
+    (memory-mapped if an annotation cache is used).
+    """
+    signal(SIGPIPE, SIG_DFL)
+    if annotation is None:
+        annotation = load_annotation(table_file, cache_dir)
+        genes = annotation.gene_table()
+    _batch_state['annotation'] = annotation
+    _batch_state['genes'] = genes
+    _batch_state['options'] = options
+    _batch_state['metric_options'] = metric_options
+
+
+def _run_batch_sample(sample):
+    """
+    This function converts one manifest sample in a batch worker. Progress output is
+    discarded, and failures are returned instead of raised so that one sample cannot
+    abort the others. The sample's stages (see Metrics) are returned with its result;
+    a profiled stage is written to output_prefix_<stage>.prof.
+    """
+    bedfile, expfile, output_prefix = sample
+    profile_stage = _batch_state['metric_options'].get('profile_stage')
+    metrics = Metrics(0, profile_stage, output_prefix+'_'+str(profile_stage)+'.prof')
+    start = time.perf_counter()
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            rows = convert_sample(_batch_state['annotation'], bedfile, expfile, output_prefix,
+                                  _batch_state['genes'], metrics=metrics, **_batch_state['options'])
+        status, error = 'OK', ''
+    except Exception as e:
+        rows = 0
+        status = 'FAILED'
+        error = " ".join(str(e).splitlines()) or repr(e)
+    return sample, status, time.perf_counter() - start, rows, error, metrics.stages
+
+
+def run_batch(annotation, samples, workers, summary_file, table_file, cache_dir=None,
+              metrics=None, **options):
+    """
+    This function converts every manifest sample against one loaded annotation,
+    fanning the samples out over a pool of worker processes. It writes a summary
+    file with the status, wall time, number of tx rows and error of every sample
+    and returns the number of failed samples. Keyword options (such as stream or
+    merge_distance) are passed on to convert_sample for every sample. The stages of
+    every sample are collected in metrics.samples (see Metrics).
+    """
+    metrics = metrics or Metrics()
+    metric_options = {'profile_stage': metrics.profile_stage}
+    genes = annotation.gene_table()
+    if 'fork' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('fork')
+        initargs = (annotation, genes, table_file, cache_dir, options, metric_options)
+    else:
+        context = multiprocessing.get_context()
+        initargs = (None, None, table_file, cache_dir, options, metric_options)
+    results = {}
+    with context.Pool(max(1, min(workers, len(samples))), _init_batch_worker, initargs) as pool:
+        for sample, status, seconds, rows, error, stages in pool.imap_unordered(_run_batch_sample,
+                                                                                samples):
+            results[sample] = (status, seconds, rows, error)
+            metrics.samples.append({'output_prefix': sample[2], 'status': status,
+                                    'wall_seconds': round(seconds, 4), 'stages': stages})
+            metrics.log("---"+sample[2]+": "+status+" ("+"%.1f" % seconds+" s)" +
+                        (" "+error if error else ""))
+    failed = 0
+    with open(summary_file, 'w') as summary:
+        print('Bed_File', 'Expression_File', 'Output_Prefix', 'Status', 'Seconds', 'Tx_Rows',
+              'Error', sep='\t', file=summary)
+        for sample in samples:
+            status, seconds, rows, error = results[sample]
+            failed += status != 'OK'
+            print(*sample, status, "%.3f" % seconds, rows, error, sep='\t', file=summary)
+    return failed
+
+
+def main(args):
+    """
+    This function runs the command line program with the parsed arguments.
+    """
+    profile_file = args.profile_file
+    if args.profile_stage and not profile_file:
+        profile_file = (args.output or os.path.splitext(args.manifest)[0])+'_'+args.profile_stage+'.prof'
+    metrics = Metrics(args.verbosity, args.profile_stage, profile_file)
+    single_sample = not args.tr2gen and not args.manifest
+
+    def read_expression():
+        with metrics.stage('read_expression', "Reading expression file", background=True) as counts:
+            expression_df = read_expression_file(args.expfile)
+            counts['isoforms'] = len(expression_df)
+        return expression_df
+
+    with ThreadPoolExecutor(2) as loader:   # Input files are read while the annotation loads
+        expression = loader.submit(read_expression) if single_sample else None
+        table_hash = loader.submit(hash_file, args.tablefile) if args.resultcache else None
+        peaks = BedChunkReader(args.bedfile, metrics=metrics) if single_sample and not args.stream \
+            else args.bedfile
+        try:
+            with metrics.stage('load_annotation', "Loading annotation table file into transcriptome") \
+                    as counts:
+                annotation = load_annotation(args.tablefile, args.cachedir)
+                counts.update(transcripts=len(annotation), exons=len(annotation.exon_starts))
+            if expression:
+                expression = expression.result()
+                metrics.show('read_expression')
+            result_cache = ResultCache(args.resultcache, table_hash.result()) if table_hash else None
+        except BaseException:
+            if isinstance(peaks, BedChunkReader):
+                peaks.close()
+            raise
+    failed = 0
+    if args.tr2gen:
+        with metrics.stage('read_bed', "Reading BED file") as counts:
+            features = read_bed_into_dataframe(args.bedfile)
+            counts['features'] = len(features)
+        with metrics.stage('tr2gen', "Converting transcriptomic to genomic coordinates") as counts:
+            genomic, blocks = tr2gen(features, annotation, counts)
+            counts['features'] = len(genomic)
+        skipped, clipped = counts['skipped'], counts['clipped']
+        with metrics.stage('write', "Writing results to file") as counts:
+            write_bed12(genomic, blocks, args.output+'_genomic.bed')
+            counts['features'] = len(genomic)
+        if skipped:
+            metrics.log(str(skipped)+" features on unknown or duplicated transcripts (or outside "
+                        "the transcript) were skipped.")
+        if clipped:
+            metrics.log(str(clipped)+" features running past the ends of their transcript were "
+                        "clipped to it.")
+    elif args.manifest:
+        samples = read_manifest(args.manifest)
+        summary_file = args.summary or os.path.splitext(args.manifest)[0]+'_summary.tsv'
+        metrics.log("Converting "+str(len(samples))+" samples with "+str(args.workers)+" workers...")
+        with metrics.stage('batch') as counts:
+            failed = run_batch(annotation, samples, args.workers, summary_file,
+                               args.tablefile, args.cachedir, metrics, stream=args.stream,
+                               merge_distance=args.merge_distance, metagene=args.metagene,
+                               isoforms=args.isoforms, result_cache=result_cache,
+                               output_format=args.output_format)
+            counts.update(samples=len(samples), failed=failed)
+        metrics.log("Done! "+str(len(samples)-failed)+" of "+str(len(samples))+" samples converted. "
+                    "Summary written to "+summary_file)
+    else:
+        convert_sample(annotation, peaks, expression, args.output,
+                       stream=args.stream, workers=args.stream_workers,
+                       merge_distance=args.merge_distance, metagene=args.metagene,
+                       isoforms=args.isoforms, result_cache=result_cache,
+                       output_format=args.output_format, metrics=metrics)
+        metrics.log("Good luck with the analysis!")
+        metrics.log("Remember, columns of tx file are:")
+        metrics.log("Tx ID | Peak Start | Peak End | Peak Names | Peak Middle | ATG | "
+                    "Stop | Tx Length | First Splice Site | Last Splice Site" +
+                    (" | Isoform Rank | Expression | UID" if args.isoforms is not None else ""))
+    if args.metrics_file:
+        metrics.write(args.metrics_file, command=sys.argv)
+    if failed:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
-    args = get_user_arguments()
     signal(SIGPIPE, SIG_DFL)
-    print("Checking program dependencies...", end=" ")
-    check_dependencies()
-    print("Done!")
-    print("Choosing most expressed isoform for each gene...", end=" ")
-    chosen = choose_selected_cufflinks(args.expfile, args.tablefile)
-    print("Done!")
-    print("Loading annotation table file into array...", end=" ")
-    tb_array = read_table_into_array(args.tablefile, chosen)
-    print("Done!")
-    print("Building transcriptome...", end=" ")
-    tx_dict = build_transcriptome(tb_array, 'txid')
-    print("Done!")
-    print("Fetching transcriptomic parameters for metagene analysis...", end=" ")
-    parameters_df = get_parameters(tx_dict)
-    print("Done!")
-    print("Converting genomic to transcriptomic coordinates...")
-    result = gen2tr(args.bedfile, tx_dict)
-    result['Peak_Middle'] = ((result['Peak_Start']+result['Peak_End'])/2)
-    merged = pd.merge(result, parameters_df, on='UID')
-    merged.drop_duplicates(inplace=True)
-    merged = merged[['Tx_ID', 'Peak_Start', 'Peak_End', 'Peak_Names',
-                     'Peak_Middle', 'ATG', 'Stop', 'Length', 'FirstSpliceSite',
-                     'LastSpliceSite']]
-    merged = merged[(merged.Peak_End - merged.Peak_Start) > 50]
-    merged.sort_values(['Tx_ID', 'Peak_Start'], ascending=[True, True],
-                       inplace=True)
-    print("Done converting genomic to transcriptomic coordinates!")
-    print("Writing results to file...", end=" ")
-    merged.to_csv(args.output+'_tx.bed', sep='\t', header=False, index=False,
-                  float_format='%.f')
-    print("Done! Good luck with the analysis!")
-    print("Remember, columns of tx file are:")
-    print("Tx ID | Peak Start | Peak End | Peak Names | Peak Middle | ATG | "
-          "Stop | Tx Length | First Splice Site | Last Splice Site")
+    try:
+        main(get_user_arguments())
+    except PeakConverterError as e:
+        print(e)
+        sys.exit(0)